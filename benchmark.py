@@ -0,0 +1,204 @@
+# benchmark.py - compare document extraction paths against the original implementations
+import argparse
+import asyncio
+import resource
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import aiosqlite
+import PyPDF2
+from docx import Document as DocxDocument
+
+from main import DATABASE_PATH, DocumentProcessor, PDF_WORKERS, db, rule_simplifier
+
+
+def legacy_extract_text_from_pdf(file_content: bytes) -> str:
+    """Original serial implementation, kept here as the baseline"""
+    pdf_reader = PyPDF2.PdfReader(BytesIO(file_content))
+    text = ""
+    for page in pdf_reader.pages:
+        text += page.extract_text() + "\n"
+    return text.strip()
+
+
+def legacy_extract_text_from_docx(file_content: bytes) -> str:
+    """Original python-docx implementation, kept here as the baseline"""
+    doc = DocxDocument(BytesIO(file_content))
+    text = ""
+    for paragraph in doc.paragraphs:
+        text += paragraph.text + "\n"
+    return text.strip()
+
+
+LEGACY_REPLACEMENTS = {
+    "whereas": "given that",
+    "heretofore": "before this",
+    "hereinafter": "from now on",
+    "aforementioned": "mentioned above",
+    "pursuant to": "according to",
+    "notwithstanding": "despite",
+    "ipso facto": "by that very fact",
+    "party of the first part": "first party",
+    "party of the second part": "second party",
+    "shall": "will",
+    "hereby": "by this",
+    "herein": "in this document",
+    "thereof": "of that",
+    "witnesseth": "shows that"
+}
+
+
+def legacy_rule_based_simplification(text: str) -> str:
+    """Original one-str.replace-per-rule implementation, kept here as the baseline"""
+    simplified = text
+    for old, new in LEGACY_REPLACEMENTS.items():
+        simplified = simplified.replace(old, new)
+    return simplified
+
+
+def _measure_in_child(func, content: bytes):
+    """Run func(content) and return (seconds, peak RSS growth in KB, output length)"""
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    text = func(content)
+    seconds = time.perf_counter() - start
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before, len(text)
+
+
+def _report(label: str, seconds: float, pages: int):
+    print(f"{label:<12} {seconds:8.3f}s  {pages / seconds:8.1f} pages/s")
+
+
+def bench_pdf(path: str, repeat: int):
+    with open(path, "rb") as f:
+        content = f.read()
+    pages = len(PyPDF2.PdfReader(BytesIO(content)).pages)
+    print(f"{path}: {pages} pages, {len(content) / 1024:.0f} KB, {PDF_WORKERS} workers")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        legacy_extract_text_from_pdf(content)
+    _report("serial", (time.perf_counter() - start) / repeat, pages)
+
+    async def run_pooled():
+        # Warm the pool once so process start-up isn't counted
+        await DocumentProcessor.extract_text_from_pdf_async(content)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await DocumentProcessor.extract_text_from_pdf_async(content)
+        return (time.perf_counter() - start) / repeat
+
+    _report("pooled", asyncio.run(run_pooled()), pages)
+
+
+def bench_docx(path: str):
+    with open(path, "rb") as f:
+        content = f.read()
+    print(f"{path}: {len(content) / 1024 / 1024:.1f} MB")
+
+    for label, func in (("python-docx", legacy_extract_text_from_docx),
+                        ("streaming", DocumentProcessor.extract_text_from_docx)):
+        # A fresh process per run so peak RSS isn't shared between the two
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            seconds, peak_kb, chars = executor.submit(_measure_in_child, func, content).result()
+        print(f"{label:<12} {seconds:8.3f}s  peak +{peak_kb / 1024:8.1f} MB  {chars} chars")
+
+
+def bench_rules(megabytes: int, repeat: int):
+    # One rule-heavy sentence per twenty plain ones, roughly the density of a real contract
+    plain = "The Tenant agrees to maintain the premises in good repair and to pay all charges when due. "
+    dense = ("WHEREAS the party of the first part shall, pursuant to the agreement herein, "
+             "pay Marshall the amount thereof notwithstanding any dispute. ")
+    paragraph = plain * 20 + dense
+    text = paragraph * (megabytes * 1024 * 1024 // len(paragraph))
+    print(f"{len(text) / 1024 / 1024:.1f} MB of text, {len(LEGACY_REPLACEMENTS)} rules")
+
+    funcs = (("str.replace", legacy_rule_based_simplification),
+             ("compiled", lambda t: rule_simplifier.simplify(t, "en")))
+    for _, func in funcs:
+        func(paragraph)  # compile the rules outside the timed runs
+    # Runs are interleaved and the best is reported, as timeit does, so that load from
+    # elsewhere on the machine doesn't land on one side only
+    best = {label: float("inf") for label, _ in funcs}
+    for _ in range(repeat):
+        for label, func in funcs:
+            start = time.perf_counter()
+            func(text)
+            best[label] = min(best[label], time.perf_counter() - start)
+    for label, seconds in best.items():
+        print(f"{label:<12} {seconds:8.3f}s  {len(text) / 1024 / 1024 / seconds:8.1f} MB/s")
+
+
+async def legacy_get_document(doc_id: str):
+    """Original connection-per-query lookup, kept here as the baseline"""
+    conn = await aiosqlite.connect(DATABASE_PATH)
+    conn.row_factory = aiosqlite.Row
+    try:
+        cursor = await conn.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
+        return await cursor.fetchone()
+    finally:
+        await conn.close()
+
+
+async def pooled_get_document(doc_id: str):
+    async with db.read() as conn:
+        cursor = await conn.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
+        return await cursor.fetchone()
+
+
+def bench_db(queries: int, concurrency: int):
+    print(f"{DATABASE_PATH}: {queries} primary-key lookups, {concurrency} at a time")
+
+    async def run(func):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await func(str(uuid.uuid4()))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(queries)))
+        return time.perf_counter() - start
+
+    async def run_all():
+        await db.open()
+        try:
+            for label, func in (("connect", legacy_get_document), ("pooled", pooled_get_document)):
+                seconds = await run(func)
+                print(f"{label:<12} {seconds:8.3f}s  {queries / seconds:8.0f} queries/s")
+        finally:
+            await db.close()
+
+    asyncio.run(run_all())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DocX Legal AI extraction benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pdf_parser = subparsers.add_parser("pdf", help="PDF page extraction throughput")
+    pdf_parser.add_argument("path")
+    pdf_parser.add_argument("--repeat", type=int, default=3)
+
+    docx_parser = subparsers.add_parser("docx", help="DOCX extraction time and peak memory")
+    docx_parser.add_argument("path")
+
+    rules_parser = subparsers.add_parser("rules", help="Rule-based simplifier throughput")
+    rules_parser.add_argument("--megabytes", type=int, default=8)
+    rules_parser.add_argument("--repeat", type=int, default=5)
+
+    db_parser = subparsers.add_parser("db", help="Per-query database overhead")
+    db_parser.add_argument("--queries", type=int, default=2000)
+    db_parser.add_argument("--concurrency", type=int, default=16)
+
+    args = parser.parse_args()
+    if args.command == "pdf":
+        bench_pdf(args.path, args.repeat)
+    elif args.command == "docx":
+        bench_docx(args.path)
+    elif args.command == "rules":
+        bench_rules(args.megabytes, args.repeat)
+    elif args.command == "db":
+        bench_db(args.queries, args.concurrency)
@@ -1,25 +1,41 @@
 # main.py (updated and enhanced)
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from python_multipart.multipart import MultipartParser, parse_options_header
+from typing import List, Optional, Dict, Any, AsyncIterator, Awaitable, Callable, Iterator, NamedTuple, Tuple, Union
 import uvicorn
 import os
 import tempfile
 import json
+import functools
+import math
+import re
+import hashlib
+import base64
+import heapq
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+import zipfile
+import xml.etree.ElementTree as ET
 from datetime import datetime
 import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 import uuid
 import logging
 import shutil
+import zlib
 
 # Document processing imports
 import PyPDF2
-from docx import Document as DocxDocument
-from PIL import Image
+from PIL import Image, ImageSequence
 import pytesseract
 import openai
 
@@ -28,6 +44,15 @@ import sqlite3
 from sqlite3 import Connection
 import aiosqlite
 
+# Retrieval imports
+import numpy as np
+
+# Optional: exact token counts for OpenAI models (an estimate is used without it)
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 # Initialize FastAPI app
 app = FastAPI(
     title="DocX Legal AI API",
@@ -50,14 +75,137 @@ app.add_middleware(
 
 # Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-key-here")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-SUPPORTED_FORMATS = ['.pdf', '.docx', '.txt', '.jpg', '.jpeg', '.png']
+# Room for multipart boundaries and part headers when checking Content-Length against MAX_FILE_SIZE
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+SUPPORTED_FORMATS = ['.pdf', '.docx', '.txt', '.jpg', '.jpeg', '.png', '.tif', '.tiff']
 DATABASE_URL = "sqlite:///./docx_legal_ai.db"
+DATABASE_PATH = "docx_legal_ai.db"
+
+# Document bodies are stored zlib-compressed, apart from the metadata rows
+BODY_COMPRESSION_LEVEL = int(os.getenv("BODY_COMPRESSION_LEVEL", "6"))
+
+# SQLite connection pool: long-lived read connections and a single serialized writer, in WAL mode
+DB_READ_CONNECTIONS = int(os.getenv("DB_READ_CONNECTIONS", "4"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", str(64 * 1024)))
+
+# PDF extraction runs in a process pool so large documents don't block the event loop
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "8"))
+
+# Hybrid PDFs: pages without a text layer are OCR'd from their embedded scan
+PDF_HYBRID_OCR = os.getenv("PDF_HYBRID_OCR", "true").lower() == "true"
+PDF_SCANNED_PAGE_MIN_CHARS = int(os.getenv("PDF_SCANNED_PAGE_MIN_CHARS", "16"))
+
+# OCR worker pool: images are downscaled, binarized and split into tiles that are OCR'd in parallel
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+# Documents (not tiles) that may have OCR queued or running at once
+OCR_QUEUE_LIMIT = int(os.getenv("OCR_QUEUE_LIMIT", "32"))
+OCR_MAX_DIMENSION = int(os.getenv("OCR_MAX_DIMENSION", "3500"))
+OCR_TILE_HEIGHT = int(os.getenv("OCR_TILE_HEIGHT", "1200"))
+OCR_BINARIZE_THRESHOLD = int(os.getenv("OCR_BINARIZE_THRESHOLD", "160"))
 
 # Create uploads directory if it doesn't exist
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Content-addressed cache of extraction results, keyed by SHA-256 of the upload
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR", os.path.join(UPLOAD_DIR, "extraction_cache"))
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Background document processing jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+
+# Long documents are simplified chunk by chunk (map) and merged back in order (reduce)
+SIMPLIFY_CHUNK_TOKENS = int(os.getenv("SIMPLIFY_CHUNK_TOKENS", "1000"))
+SIMPLIFY_MAX_CONCURRENCY = int(os.getenv("SIMPLIFY_MAX_CONCURRENCY", "8"))
+
+# /simplify/batch limits
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+
+# Rule-based fallback simplifier: one JSON file of phrase -> replacement per language
+RULES_DIR = os.getenv("RULES_DIR", "rules")
+
+# Per-document BM25 clause indexes kept in memory
+CLAUSE_INDEX_CACHE_SIZE = int(os.getenv("CLAUSE_INDEX_CACHE_SIZE", "256"))
+
+# Chat context: the document chunks most similar to the question, packed into a token budget
+CHAT_CONTEXT_CHUNK_TOKENS = int(os.getenv("CHAT_CONTEXT_CHUNK_TOKENS", "200"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "1500"))
+
+# Prompt budgeting: prompts are measured in model tokens and, together with the reply,
+# fill at most PROMPT_CONTEXT_FRACTION of the model's context window
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000
+}
+OPENAI_CONTEXT_WINDOW = int(os.getenv("OPENAI_CONTEXT_WINDOW", str(MODEL_CONTEXT_WINDOWS.get(OPENAI_MODEL, 4096))))
+PROMPT_CONTEXT_FRACTION = float(os.getenv("PROMPT_CONTEXT_FRACTION", "0.9"))
+SIMPLIFY_MAX_OUTPUT_TOKENS = int(os.getenv("SIMPLIFY_MAX_OUTPUT_TOKENS", "2000"))
+CHAT_MAX_OUTPUT_TOKENS = int(os.getenv("CHAT_MAX_OUTPUT_TOKENS", "1000"))
+
+# OpenAI client flow control: an AIMD concurrency limit fed by 429s and latency, jittered
+# retries within a per-call deadline, and a circuit breaker that sheds calls while the API is down
+OPENAI_INITIAL_CONCURRENCY = int(os.getenv("OPENAI_INITIAL_CONCURRENCY", "8"))
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", "1"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", "256"))
+OPENAI_LATENCY_TARGET_SECONDS = float(os.getenv("OPENAI_LATENCY_TARGET_SECONDS", "60"))
+OPENAI_DEADLINE_SECONDS = float(os.getenv("OPENAI_DEADLINE_SECONDS", "120"))
+OPENAI_RETRY_BASE_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", "0.5"))
+OPENAI_RETRY_MAX_SECONDS = float(os.getenv("OPENAI_RETRY_MAX_SECONDS", "10"))
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_RESET_SECONDS = float(os.getenv("OPENAI_BREAKER_RESET_SECONDS", "30"))
+
+# Model response cache. Bump PROMPT_TEMPLATE_VERSION whenever a prompt template changes.
+PROMPT_TEMPLATE_VERSION = "2"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "1024"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+# last_access only orders trimming, so a cache hit refreshes it at most this often
+LLM_CACHE_TOUCH_INTERVAL = float(os.getenv("LLM_CACHE_TOUCH_INTERVAL", "3600"))
+
+# Clause simplifications are shared by every document with the same clause; unseen ones
+# go to the model at most CLAUSE_BATCH_MAX_CLAUSES to a prompt
+CLAUSE_CACHE_MEMORY_ENTRIES = int(os.getenv("CLAUSE_CACHE_MEMORY_ENTRIES", "4096"))
+CLAUSE_CACHE_MAX_ENTRIES = int(os.getenv("CLAUSE_CACHE_MAX_ENTRIES", "500000"))
+CLAUSE_BATCH_MAX_CLAUSES = int(os.getenv("CLAUSE_BATCH_MAX_CLAUSES", "40"))
+
+# /stats aggregates are kept up to date on every write and recomputed from scratch this often
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))
+
+# /documents pages
+DOCUMENTS_PAGE_SIZE = int(os.getenv("DOCUMENTS_PAGE_SIZE", "50"))
+DOCUMENTS_MAX_PAGE_SIZE = int(os.getenv("DOCUMENTS_MAX_PAGE_SIZE", "200"))
+
+# /search: FTS5 index over document text
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "100"))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "1000"))
+SEARCH_SNIPPET_TOKENS = int(os.getenv("SEARCH_SNIPPET_TOKENS", "24"))
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "10000"))
+
+# unicode61 splits words at Devanagari vowel signs and viramas unless they are declared token characters
+_DEVANAGARI_MARKS = "".join(chr(c) for start, stop in ((0x900, 0x904), (0x93A, 0x958), (0x962, 0x964))
+                            for c in range(start, stop))
+FTS_TOKENIZER = f"porter unicode61 remove_diacritics 2 tokenchars '{_DEVANAGARI_MARKS}'"
+
+# Chat history pages
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "50"))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_MAX_PAGE_SIZE", "200"))
+
 # Pydantic models
 class DocumentResponse(BaseModel):
     id: str
@@ -74,6 +222,7 @@ class ChatMessage(BaseModel):
     message: str
     document_id: Optional[str] = None
     language: str = "en"
+    session_id: Optional[str] = None  # continue an existing conversation
 
 class ChatResponse(BaseModel):
     response: str
@@ -86,6 +235,10 @@ class SimplificationRequest(BaseModel):
     target_language: str = "en"
     complexity_level: str = "simple"  # simple, intermediate, advanced
 
+class BatchSimplificationRequest(BaseModel):
+    items: List[SimplificationRequest]
+    concurrency: int = 4
+
 class UserRegistration(BaseModel):
     email: str
     password: str
@@ -96,14 +249,45 @@ class UserLogin(BaseModel):
     password: str
 
 # Database setup
+def compress_text(text: Optional[str]) -> Optional[bytes]:
+    return None if text is None else zlib.compress(text.encode('utf-8'), BODY_COMPRESSION_LEVEL)
+
+def decompress_text(blob: Optional[bytes]) -> Optional[str]:
+    """Also registered as the decompress_text() SQL function on every connection"""
+    return None if blob is None else zlib.decompress(blob).decode('utf-8')
+
+def _migrate_inline_bodies(conn: Connection):
+    """Move bodies stored inline in documents (the layout before document_bodies) out and compress them"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(documents)')}
+    if 'original_text' not in columns:
+        return
+
+    # The search index of the inline layout reads those columns; it is rebuilt over document_bodies
+    for trigger in ('documents_fts_insert', 'documents_fts_delete', 'documents_fts_update'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('DROP TABLE IF EXISTS documents_fts')
+
+    rows = conn.execute('SELECT id, original_text, simplified_text FROM documents')
+    conn.executemany(
+        'INSERT OR IGNORE INTO document_bodies (document_id, original_text, simplified_text) VALUES (?, ?, ?)',
+        ((doc_id, compress_text(original), compress_text(simplified)) for doc_id, original, simplified in rows)
+    )
+    conn.execute('ALTER TABLE documents DROP COLUMN original_text')
+    conn.execute('ALTER TABLE documents DROP COLUMN simplified_text')
+    conn.commit()
+    # Give back the space the inline bodies took
+    conn.execute('VACUUM')
+    logger.info("Moved document bodies into compressed storage")
+
 def init_db():
-    with sqlite3.connect('docx_legal_ai.db') as conn:
+    with sqlite3.connect(DATABASE_PATH) as conn:
+        conn.create_function('decompress_text', 1, decompress_text, deterministic=True)
+        # WAL is a property of the database file, so setting it once here covers every connection
+        conn.execute('PRAGMA journal_mode=WAL')
         conn.execute('''
             CREATE TABLE IF NOT EXISTS documents (
                 id TEXT PRIMARY KEY,
                 filename TEXT NOT NULL,
-                original_text TEXT,
-                simplified_text TEXT,
                 language TEXT,
                 processing_time REAL,
                 clause_count INTEGER,
@@ -113,6 +297,79 @@ def init_db():
                 user_id TEXT
             )
         ''')
+        # Keyset pagination of /documents, newest first, optionally filtered by status or language
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_upload ON documents (upload_time, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_status_upload ON documents (status, upload_time, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_language_upload ON documents (language, upload_time, id)')
+
+        # Bodies are kept out of documents so metadata queries never read them, and only
+        # decompressed when asked for (through document_text, or decompress_text())
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_bodies (
+                body_id INTEGER PRIMARY KEY,
+                document_id TEXT NOT NULL UNIQUE,
+                original_text BLOB,
+                simplified_text BLOB
+            )
+        ''')
+        conn.execute('''
+            CREATE VIEW IF NOT EXISTS document_text AS
+            SELECT body_id, document_id,
+                   decompress_text(original_text) AS original_text,
+                   decompress_text(simplified_text) AS simplified_text
+            FROM document_bodies
+        ''')
+        _migrate_inline_bodies(conn)
+
+        # Full-text index over the decompressed bodies (external content, so the text isn't
+        # stored again), keyed on body_id and kept in sync by triggers on document_bodies
+        fts_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'documents_fts'").fetchone()
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                original_text, simplified_text,
+                content='document_text', content_rowid='body_id',
+                tokenize="{FTS_TOKENIZER}"
+            )
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS document_bodies_fts_insert AFTER INSERT ON document_bodies BEGIN
+                INSERT INTO documents_fts (rowid, original_text, simplified_text)
+                VALUES (new.body_id, decompress_text(new.original_text), decompress_text(new.simplified_text));
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS document_bodies_fts_delete AFTER DELETE ON document_bodies BEGIN
+                INSERT INTO documents_fts (documents_fts, rowid, original_text, simplified_text)
+                VALUES ('delete', old.body_id, decompress_text(old.original_text), decompress_text(old.simplified_text));
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS document_bodies_fts_update
+            AFTER UPDATE OF original_text, simplified_text ON document_bodies BEGIN
+                INSERT INTO documents_fts (documents_fts, rowid, original_text, simplified_text)
+                VALUES ('delete', old.body_id, decompress_text(old.original_text), decompress_text(old.simplified_text));
+                INSERT INTO documents_fts (rowid, original_text, simplified_text)
+                VALUES (new.body_id, decompress_text(new.original_text), decompress_text(new.simplified_text));
+            END
+        ''')
+        if not fts_exists:
+            # Index documents stored before the search index existed
+            conn.execute("INSERT INTO documents_fts (documents_fts) VALUES ('rebuild')")
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_documents INTEGER NOT NULL DEFAULT 0,
+                completed_documents INTEGER NOT NULL DEFAULT 0,
+                total_words INTEGER NOT NULL DEFAULT 0,
+                total_processing_time REAL NOT NULL DEFAULT 0,
+                language_distribution TEXT NOT NULL DEFAULT '{}',
+                status_distribution TEXT NOT NULL DEFAULT '{}',
+                updated_at TEXT,
+                reconciled_at TEXT
+            )
+        ''')
+        conn.execute('INSERT OR IGNORE INTO document_stats (id) VALUES (1)')
         
         conn.execute('''
             CREATE TABLE IF NOT EXISTS chat_sessions (
@@ -123,6 +380,27 @@ def init_db():
                 updated_at TEXT
             )
         ''')
+
+        # One row per chat turn, appended; chat_sessions.messages is only read by the migration below
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                user_message TEXT NOT NULL,
+                ai_response TEXT NOT NULL,
+                created_at TEXT,
+                PRIMARY KEY (session_id, seq)
+            )
+        ''')
+        # Move conversations stored as one JSON blob per session into chat_messages
+        conn.execute('''
+            INSERT OR IGNORE INTO chat_messages (session_id, seq, user_message, ai_response, created_at)
+            SELECT s.session_id, m.key + 1, json_extract(m.value, '$.user_message'),
+                   json_extract(m.value, '$.ai_response'), json_extract(m.value, '$.timestamp')
+            FROM chat_sessions s, json_each(s.messages) m
+            WHERE s.messages IS NOT NULL AND json_valid(s.messages)
+        ''')
+        conn.execute('UPDATE chat_sessions SET messages = NULL WHERE messages IS NOT NULL')
         
         conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -134,284 +412,3000 @@ def init_db():
                 last_login TEXT
             )
         ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                document_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                file_ext TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                language TEXT,
+                complexity TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                heartbeat_at TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)')
+
+        # Clauses are segmented once, at ingestion; each row is a span of the original text
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS clauses (
+                document_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                number TEXT,
+                start_offset INTEGER NOT NULL,
+                end_offset INTEGER NOT NULL,
+                PRIMARY KEY (document_id, seq)
+            ) WITHOUT ROWID
+        ''')
+        # Indexes built over the old split-on-periods clauses are rebuilt from clause rows on first use
+        if 'clauses' in {row[1] for row in conn.execute('PRAGMA table_info(clause_indexes)')}:
+            conn.execute('DROP TABLE clause_indexes')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS clause_indexes (
+                document_id TEXT PRIMARY KEY,
+                postings TEXT NOT NULL
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS clause_simplifications (
+                key TEXT PRIMARY KEY,
+                simplified TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        ''')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_clause_simplifications_last_access ON clause_simplifications (last_access)'
+        )
         
         conn.commit()
 
-# Initialize database
-init_db()
+# Initialize database
+init_db()
+
+# Helper Functions
+
+# Parsers accept either the raw bytes of a document or the path of a file holding them
+DocumentSource = Union[bytes, str]
+
+def _open_source(source: DocumentSource):
+    return BytesIO(source) if isinstance(source, bytes) else source
+
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    """Lazily create the process pool used for PDF page extraction"""
+    global _pdf_executor
+    if _pdf_executor is None:
+        _pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    return _pdf_executor
+
+def discard_pdf_executor(executor: ProcessPoolExecutor):
+    """Drop a pool that lost a worker; the next get_pdf_executor() starts a fresh one"""
+    global _pdf_executor
+    if _pdf_executor is executor:
+        _pdf_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _pdf_error(e: Exception, executor: ProcessPoolExecutor) -> HTTPException:
+    """A worker crash is our problem and worth retrying; anything else means the PDF is unreadable"""
+    if isinstance(e, BrokenProcessPool):
+        discard_pdf_executor(executor)
+        logger.warning("PDF worker died, restarting the PDF process pool")
+        return HTTPException(status_code=503, detail="PDF worker crashed, please retry later")
+    return HTTPException(status_code=400, detail=f"Error processing PDF: {str(e)}")
+
+def _count_pdf_pages(source: DocumentSource) -> int:
+    return len(PyPDF2.PdfReader(_open_source(source)).pages)
+
+def _largest_page_image(page) -> Optional[bytes]:
+    """Return the biggest embedded image of a page, which for a scanned page is the scan itself"""
+    try:
+        images = page.images
+    except Exception:
+        return None
+    if not images:
+        return None
+    return max(images, key=lambda image: len(image.data)).data
+
+def _extract_pdf_pages(source: DocumentSource, start: int, stop: int,
+                       ocr_scanned_pages: bool = False) -> List[Tuple[str, Optional[bytes]]]:
+    """Extract pages [start, stop) of a PDF (runs inside the PDF process pool)
+
+    Returns (text, scan) per page; scan holds the page image when the page has no
+    usable text layer and ocr_scanned_pages is set, otherwise None.
+    """
+    pdf_reader = PyPDF2.PdfReader(_open_source(source))
+    pages = []
+    for i in range(start, stop):
+        page = pdf_reader.pages[i]
+        text = page.extract_text() or ""
+        scan = None
+        if ocr_scanned_pages and len(text.strip()) < PDF_SCANNED_PAGE_MIN_CHARS:
+            scan = _largest_page_image(page)
+        pages.append((text, scan))
+    return pages
+
+def _preprocess_for_ocr(image: Image.Image) -> Image.Image:
+    """Grayscale, downscale oversized scans and binarize so tesseract has less to chew on"""
+    image = image.convert("L")
+    if max(image.size) > OCR_MAX_DIMENSION:
+        image.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)
+    return image.point(lambda pixel: 255 if pixel > OCR_BINARIZE_THRESHOLD else 0, mode="1")
+
+def _find_tile_boundary(image: Image.Image, target: int, window: int) -> int:
+    """Pick the whitest row near target so tiles are not cut through a line of text"""
+    width = image.size[0]
+    best_row, best_white = target, -1
+    for row in range(max(target - window, 1), min(target + window, image.size[1] - 1)):
+        white = image.crop((0, row, width, row + 1)).histogram()[-1]
+        if white > best_white:
+            best_row, best_white = row, white
+            if white == width:
+                break
+    return best_row
+
+def _plain_errors(func: Callable) -> Callable:
+    """Re-raise a pool task's exceptions as RuntimeError
+
+    Some library exceptions (pytesseract's TesseractNotFoundError, for one) can't be
+    unpickled in the parent, which then sees a BrokenProcessPool instead.
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except Exception as e:
+            raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    return wrapper
+
+@_plain_errors
+def _prepare_ocr_tiles(source: DocumentSource) -> List[bytes]:
+    """Preprocess every frame of an image and split tall frames into strips (runs in the OCR pool)"""
+    tiles = []
+    with Image.open(_open_source(source)) as image:
+        for frame in ImageSequence.Iterator(image):
+            page = _preprocess_for_ocr(frame)
+            width, height = page.size
+            top = 0
+            while top < height:
+                bottom = height
+                if height - top > OCR_TILE_HEIGHT * 1.5:
+                    bottom = _find_tile_boundary(page, top + OCR_TILE_HEIGHT, OCR_TILE_HEIGHT // 8)
+                buffer = BytesIO()
+                page.crop((0, top, width, bottom)).save(buffer, format="PNG")
+                tiles.append(buffer.getvalue())
+                top = bottom
+    return tiles
+
+@_plain_errors
+def _ocr_tile(tile_content: bytes) -> str:
+    return pytesseract.image_to_string(Image.open(BytesIO(tile_content))).strip()
+
+class OCRWorkerPool:
+    """Bounded process pool for tesseract with queue depth accounting
+
+    Admission is per document: up to queue_limit documents may have OCR in flight, and
+    all the tiles of an admitted document are queued for the workers however many there are.
+    """
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(workers)
+        self.documents = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        """Drop a pool that lost a worker; the next task starts a fresh one"""
+        if self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            logger.warning("OCR worker died, restarting the OCR process pool")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def admit(self):
+        """Take a slot for one document's OCR; every admit() needs a matching release()"""
+        if self.documents >= self.queue_limit:
+            raise HTTPException(status_code=503, detail="OCR queue is full, please retry later")
+        self.documents += 1
+
+    def release(self):
+        self.documents -= 1
+
+    async def _run(self, func, *args):
+        self.queued += 1
+        waiting = True
+        try:
+            # Only hand `workers` tasks to the executor so the wait is visible as queue depth
+            async with self._slots:
+                self.queued -= 1
+                waiting = False
+                self.running += 1
+                executor = self._get_executor()
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+                except BrokenProcessPool:
+                    self.failed += 1
+                    self._discard_executor(executor)
+                    raise HTTPException(status_code=503, detail="OCR worker crashed, please retry later")
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.running -= 1
+                self.completed += 1
+                return result
+        finally:
+            if waiting:
+                self.queued -= 1
+
+    async def ocr_image(self, source: DocumentSource) -> str:
+        """OCR an image of an admitted document, processing its frames and tiles in parallel"""
+        tiles = await self._run(_prepare_ocr_tiles, source)
+        tasks = [asyncio.ensure_future(self._run(_ocr_tile, tile)) for tile in tiles]
+        try:
+            texts = await asyncio.gather(*tasks)
+        finally:
+            # When one tile fails (or the caller gives up) the rest of the image is not needed
+            for task in tasks:
+                task.cancel()
+        return "\n".join(text for text in texts if text).strip()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": self.workers,
+            "documents": self.documents,
+            "queue_depth": self.queued,
+            "queue_limit": self.queue_limit,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "restarts": self.restarts
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+ocr_pool = OCRWorkerPool(OCR_WORKERS, OCR_QUEUE_LIMIT)
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def iter_docx_blocks(source: DocumentSource) -> Iterator[str]:
+    """Stream paragraphs and table rows from word/document.xml in document order
+
+    The XML is iterparsed straight out of the zip and finished blocks are dropped
+    from the tree, so memory stays bounded by the largest single paragraph or table.
+    Table rows are emitted as their cells joined with " | ".
+    """
+    with zipfile.ZipFile(_open_source(source)) as archive:
+        with archive.open("word/document.xml") as document_xml:
+            parts: List[str] = []
+            # One (row cells, current cell paragraphs) pair per open table, innermost last
+            tables: List[Tuple[List[str], List[str]]] = []
+            stack: List[ET.Element] = []
+
+            for event, elem in ET.iterparse(document_xml, events=("start", "end")):
+                if event == "start":
+                    stack.append(elem)
+                    if elem.tag == _W + "tbl":
+                        tables.append(([], []))
+                    continue
+
+                stack.pop()
+                tag = elem.tag
+                if tag == _W + "t":
+                    parts.append(elem.text or "")
+                elif tag == _W + "tab":
+                    # <w:tab/> inside a run is a tab character; under <w:pPr><w:tabs> it is a tab stop
+                    if stack and stack[-1].tag == _W + "r":
+                        parts.append("\t")
+                elif tag in (_W + "br", _W + "cr"):
+                    parts.append("\n")
+                elif tag == _W + "p":
+                    paragraph = "".join(parts)
+                    parts = []
+                    if tables:
+                        tables[-1][1].append(paragraph)
+                    elif paragraph.strip():
+                        yield paragraph
+                    elem.clear()
+                elif tag == _W + "tc":
+                    cells, paragraphs = tables[-1]
+                    cells.append(" ".join(p.strip() for p in paragraphs if p.strip()))
+                    paragraphs.clear()
+                elif tag == _W + "tr":
+                    cells = tables[-1][0]
+                    row = " | ".join(cells)
+                    cells.clear()
+                    if len(tables) > 1:
+                        # Rows of a nested table become part of the enclosing cell
+                        tables[-2][1].append(row)
+                    elif row.strip(" |"):
+                        yield row
+                elif tag == _W + "tbl":
+                    tables.pop()
+
+                # Drop finished children of <w:body> so the tree never holds the whole document
+                if len(stack) == 2:
+                    stack[-1].remove(elem)
+
+def _read_text_file(path: str) -> str:
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+class DocumentProcessor:
+    @staticmethod
+    async def iter_pdf_pages(source: DocumentSource, ocr_scanned_pages: bool = PDF_HYBRID_OCR) -> AsyncIterator[str]:
+        """Yield page texts in order, extracting page ranges in parallel in the PDF process pool
+
+        With ocr_scanned_pages, pages that have no text layer are sent to the OCR pool;
+        every other page stays on the PyPDF2 path. A scanned page's OCR output is added
+        to whatever text layer it has; if OCR fails the page keeps just its text layer.
+        """
+        loop = asyncio.get_running_loop()
+        executor = get_pdf_executor()
+        try:
+            page_count = await loop.run_in_executor(executor, _count_pdf_pages, source)
+        except Exception as e:
+            raise _pdf_error(e, executor)
+
+        # Each task re-opens and parses the PDF, so keep the number of ranges close to the worker count
+        if page_count < PDF_PARALLEL_MIN_PAGES:
+            pages_per_task = max(page_count, 1)
+        else:
+            pages_per_task = math.ceil(page_count / (PDF_WORKERS * 2))
+
+        futures = [
+            loop.run_in_executor(executor, _extract_pdf_pages, source, start,
+                                 min(start + pages_per_task, page_count), ocr_scanned_pages)
+            for start in range(0, page_count, pages_per_task)
+        ]
+        ocr_futures = []
+        admitted = False
+        page_number = 0
+        try:
+            for future in futures:
+                try:
+                    pages = await future
+                except Exception as e:
+                    raise _pdf_error(e, executor)
+
+                # Start OCR for every scanned page of the range before waiting on any of them
+                results = []
+                for text, scan in pages:
+                    ocr_future = None
+                    if scan is not None:
+                        if not admitted:
+                            ocr_pool.admit()
+                            admitted = True
+                        ocr_future = asyncio.ensure_future(ocr_pool.ocr_image(scan))
+                        ocr_futures.append(ocr_future)
+                    results.append((text, ocr_future))
+
+                for text, ocr_future in results:
+                    page_number += 1
+                    if ocr_future is None:
+                        yield text
+                        continue
+                    try:
+                        ocr_text = await ocr_future
+                    except HTTPException as e:
+                        if e.status_code >= 500:
+                            raise
+                        logger.warning(f"OCR failed on PDF page {page_number}, keeping its text layer: {e.detail}")
+                        ocr_text = ""
+                    except Exception as e:
+                        logger.warning(f"OCR failed on PDF page {page_number}, keeping its text layer: {str(e)}")
+                        ocr_text = ""
+                    # A scanned page may still carry a few words of text layer (a header, a stamp)
+                    yield "\n".join(part for part in (text.strip(), ocr_text) if part)
+        finally:
+            for future in futures + ocr_futures:
+                future.cancel()
+            if admitted:
+                ocr_pool.release()
+
+    @staticmethod
+    async def extract_text_from_pdf_async(source: DocumentSource) -> str:
+        pages = [page_text async for page_text in DocumentProcessor.iter_pdf_pages(source)]
+        return "\n".join(pages).strip()
+
+    @staticmethod
+    def extract_text_from_docx(source: DocumentSource) -> str:
+        try:
+            return "\n".join(iter_docx_blocks(source)).strip()
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Error processing DOCX: {str(e)}")
+
+    @staticmethod
+    async def extract_text(source: DocumentSource, file_ext: str) -> str:
+        """Extract text from an uploaded file without blocking the event loop"""
+        if file_ext == '.txt':
+            if isinstance(source, bytes):
+                return source.decode('utf-8')
+            return await asyncio.to_thread(_read_text_file, source)
+        if file_ext == '.pdf':
+            return await DocumentProcessor.extract_text_from_pdf_async(source)
+
+        if file_ext == '.docx':
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, DocumentProcessor.extract_text_from_docx, source)
+
+        ocr_pool.admit()
+        try:
+            return await ocr_pool.ocr_image(source)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
+        finally:
+            ocr_pool.release()
+
+# Clause segmentation
+class Clause(NamedTuple):
+    """One heading or clause of a document, as [start, end) offsets into its original text"""
+    start: int
+    end: int
+    kind: str
+    number: Optional[str]
+
+class ClauseSegmenter:
+    """Split legal text into headings and clauses with their offsets
+
+    A line opening with an enumerator ("1.", "4.2", "(a)", "(iv)", "b)") starts a new
+    clause, and short unpunctuated lines ("DEFINITIONS", "ARTICLE 5", "1. Definitions")
+    are headings. Within a paragraph a clause ends at sentence or list punctuation,
+    except after abbreviations ("Ltd.", "Sec. 5", "e.g.") and initials. Every clause
+    carries the number of the section and list item it falls under, e.g. "4.2(a)".
+    """
+
+    # Bump when segmentation changes, so cached segmentations are redone
+    VERSION = 2
+
+    HEADING_MAX_CHARS = 80
+    HEADING_MAX_WORDS = 8
+
+    # Never end a sentence
+    ABBREVIATIONS = frozenset("""
+    ltd pvt inc co corp llp bros mr mrs ms dr sr jr st hon govt dept regd viz etc vs cf approx ors anr
+    sec secs art arts cl cls para paras sch subsec jan feb mar apr jun jul aug sep sept oct nov dec
+    """.split())
+    # Don't end a sentence when a number follows ("No. 5", "Rs. 5,000", "pp. 3-4")
+    NUMBER_ABBREVIATIONS = frozenset("no nos rs vol p pp pg fig r reg regs ch s ss".split())
+
+    # Each line, without its surrounding whitespace
+    _LINE = re.compile(r'[^\S\n]*([^\n]*?)[^\S\n]*(?:\n|\Z)')
+    _ENUMERATOR = re.compile(
+        r'(?:(?P<section>\d+(?:\.\d+)+\.?|\d+\.)'
+        r'|(?P<item>\((?:\d{1,3}|[a-z]{1,2}|[A-Z]|[ivxlc]{1,6}|[IVXLC]{1,6})\)|(?:\d{1,3}|[a-z]{1,2}|[ivxlc]{1,6})\)))'
+        r'(?:\s+|$)'
+    )
+    _HEADING_KEYWORD = re.compile(
+        r'(?:ARTICLE|Article|SECTION|Section|CLAUSE|Clause|SCHEDULE|Schedule|PART|Part|CHAPTER|Chapter|'
+        r'ANNEXURE|Annexure|ANNEX|Annex|APPENDIX|Appendix|EXHIBIT|Exhibit)\s+(?P<number>\d+[A-Z]?|[IVXLC]+|[A-Z])\b'
+    )
+    # Candidate clause ends: sentence, list or danda punctuation, any closing quotes or brackets, then whitespace
+    _BOUNDARY = re.compile(r'(?P<word>\S*?)[.;:!?।॥](?P<close>["\')\]’”]*)\s+')
+
+    def segment(self, text: str) -> List[Clause]:
+        clauses: List[Clause] = []
+        section: Optional[str] = None
+        item: Optional[str] = None
+        # The paragraph being collected: its span and the number of its first clause
+        block: Optional[List[Any]] = None
+
+        def flush():
+            nonlocal block, section
+            if block is not None:
+                section = self._split(text, block[0], block[1], block[2], section, clauses)
+                block = None
+
+        for line in self._LINE.finditer(text):
+            start, end = line.span(1)
+            if start == end:
+                # A blank line ends the paragraph; the next one only belongs to the section
+                flush()
+                item = None
+                continue
+
+            enumerator = self._ENUMERATOR.match(text, start, end)
+            heading_number = self._heading_number(text[enumerator.end() if enumerator else start:end], enumerator)
+            if heading_number is not False:
+                flush()
+                if heading_number:
+                    section, item = heading_number, None
+                clauses.append(Clause(start, end, "heading", heading_number or None))
+                continue
+
+            if enumerator:
+                flush()
+                if enumerator.group('section'):
+                    section, item = enumerator.group('section').rstrip('.'), None
+                else:
+                    item = enumerator.group('item')
+                block = [start, end, self._number(section, item)]
+            elif block is not None:
+                # A wrapped line of the same paragraph
+                block[1] = end
+            else:
+                block = [start, end, self._number(section, item)]
+        flush()
+        return clauses
+
+    def _heading_number(self, line: str, enumerator: Optional["re.Match[str]"]) -> Union[str, bool]:
+        """The heading's number ("" if it has none) when line is a heading, otherwise False"""
+        if not line or len(line) > self.HEADING_MAX_CHARS or line[-1] in ",;":
+            return False
+        if enumerator and not enumerator.group('section'):
+            # "(a) ABC LTD" is a list item naming a party, not a heading
+            return False
+        number = enumerator.group('section').rstrip('.') if enumerator else ""
+        words = line.split()
+        if line.isupper() and len(words) <= 2 * self.HEADING_MAX_WORDS and not (line[-1] in ".!?" and len(words) > 3):
+            keyword = self._HEADING_KEYWORD.match(line)
+            return number or (keyword.group('number') if keyword else "")
+        if len(words) > self.HEADING_MAX_WORDS or line[-1] in ".:!?।":
+            return False
+        keyword = self._HEADING_KEYWORD.match(line)
+        if keyword:
+            return number or keyword.group('number')
+        if number and line[0].isupper():
+            return number
+        return False
+
+    def _split(self, text: str, start: int, end: int, number: Optional[str], section: Optional[str],
+               clauses: List[Clause]) -> Optional[str]:
+        """Append the clauses of the paragraph text[start:end]; returns the section number in effect after it"""
+        clause_start = start
+        for boundary in self._BOUNDARY.finditer(text, start, end):
+            if not self._is_boundary(text, boundary, end):
+                continue
+            clauses.append(Clause(clause_start, boundary.end('close'), "clause", number))
+            clause_start = boundary.end()
+            enumerator = self._ENUMERATOR.match(text, clause_start, end)
+            if enumerator and enumerator.group('section'):
+                # A numbered clause run on from the previous one: "... rent. 1.2 The Landlord ..."
+                section = number = enumerator.group('section').rstrip('.')
+            elif enumerator:
+                # An inline list item: "shall: (a) pay rent; (b) ..."
+                number = self._number(section, enumerator.group('item'))
+        if clause_start < end:
+            clauses.append(Clause(clause_start, end, "clause", number))
+        return section
+
+    def _is_boundary(self, text: str, boundary: "re.Match[str]", end: int) -> bool:
+        following = boundary.end()
+        if following >= end:
+            return False
+        mark = text[boundary.end('word')]
+        if mark in "।॥":
+            return True
+        next_char = text[following]
+        if next_char.islower():
+            return False
+        if mark == ":":
+            # Only a lead-in to a list ends a clause
+            return self._ENUMERATOR.match(text, following, end) is not None
+        if mark == ".":
+            word = boundary.group('word').lstrip("([\"'‘“").lower()
+            if "." in word or (len(word) == 1 and word.isalpha()) or word in self.ABBREVIATIONS:
+                return False
+            if word in self.NUMBER_ABBREVIATIONS and next_char.isdigit():
+                return False
+        return True
+
+    @staticmethod
+    def _number(section: Optional[str], item: Optional[str]) -> Optional[str]:
+        if item is None:
+            return section
+        return (section or "") + item
+
+    def body(self, text: str, clause: Clause) -> Tuple[str, bool]:
+        """A clause's text without its leading enumerator, and whether it had one"""
+        enumerator = self._ENUMERATOR.match(text, clause.start, clause.end)
+        if enumerator is None:
+            return text[clause.start:clause.end], False
+        return text[enumerator.end():clause.end], True
+
+    @staticmethod
+    def normalize(body: str) -> str:
+        """Clause text as compared across documents: lowercased, whitespace collapsed, trailing punctuation dropped"""
+        return " ".join(body.lower().split()).rstrip(" .;:,")
+
+    @staticmethod
+    def texts(text: str, clauses: List[Clause]) -> List[str]:
+        """The text of each clause, leaving out headings"""
+        return [text[clause.start:clause.end] for clause in clauses if clause.kind == "clause"]
+
+clause_segmenter = ClauseSegmenter()
+
+class ExtractionCache:
+    """On-disk cache of extracted text and clauses keyed by the SHA-256 of the upload
+
+    Entries are evicted least-recently-used first (by file mtime, refreshed on every
+    hit) once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size: Optional[int] = None
+        self._size_lock = threading.Lock()
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, content_hash[:2], f"{content_hash}.json")
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _add_size(self, delta: int) -> int:
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += delta
+            return self._size
+
+    def _read(self, content_hash: str) -> Optional[dict]:
+        path = self._path(content_hash)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+            return entry
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, content_hash: str, entry: dict):
+        path = self._path(content_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        size = os.path.getsize(tmp_path)
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        if self._add_size(size - previous) > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Drop the least recently used entries until the cache is back under 90% of its limit"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.evictions += 1
+        with self._size_lock:
+            self._size = total
+
+    async def get(self, content_hash: str) -> Optional[dict]:
+        entry = await asyncio.to_thread(self._read, content_hash)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def put(self, content_hash: str, text: str, clauses: List[Clause]):
+        entry = {"text": text, "clauses": clauses, "segmenter": ClauseSegmenter.VERSION}
+        try:
+            await asyncio.to_thread(self._write, content_hash, entry)
+        except OSError as e:
+            logger.warning(f"Could not write extraction cache entry {content_hash}: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self._size,
+            "max_bytes": self.max_bytes
+        }
+
+extraction_cache = ExtractionCache(EXTRACTION_CACHE_DIR, EXTRACTION_CACHE_MAX_BYTES)
+
+def _file_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB")
+
+async def receive_upload(request: Request) -> Tuple[str, str, str, str]:
+    """Stream the "file" part of a multipart upload straight to a temp file under UPLOAD_DIR
+
+    The request body is parsed as it arrives rather than through request.form(), which
+    would spool the whole body to disk before we saw any of it. A Content-Length past
+    the limit is refused before anything is read; otherwise the upload is hashed as it
+    is written and refused as soon as it passes MAX_FILE_SIZE.
+
+    Returns (filename, extension, path, sha256 hex digest). The caller owns the file and must remove it.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + UPLOAD_FORM_OVERHEAD:
+        raise _file_too_large()
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+    headers: Dict[bytes, bytes] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+    # The "file" part: its name and extension once its headers are in, the data not yet written
+    upload: Dict[str, Any] = {"filename": None, "ext": None, "in_file_part": False}
+    pending: List[bytes] = []
+
+    def on_part_begin():
+        headers.clear()
+        upload["in_file_part"] = False
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+        if disposition.get(b"name") == b"file" and upload["filename"] is None:
+            upload["filename"] = disposition.get(b"filename", b"").decode("utf-8", "replace")
+            upload["ext"] = os.path.splitext(upload["filename"])[1].lower()
+            upload["in_file_part"] = True
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if upload["in_file_part"]:
+            pending.append(data[start:end])
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    })
+
+    hasher = hashlib.sha256()
+    size = 0
+    out = None
+    path = None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if upload["filename"] is not None and out is None:
+                # Check the file name before writing any of the file
+                if not upload["filename"]:
+                    raise HTTPException(status_code=400, detail="No file provided")
+                if upload["ext"] not in SUPPORTED_FORMATS:
+                    raise HTTPException(status_code=400, detail=f"Unsupported file format. Supported: {SUPPORTED_FORMATS}")
+                fd, path = tempfile.mkstemp(suffix=upload["ext"], dir=UPLOAD_DIR)
+                out = os.fdopen(fd, "wb")
+            for data in pending:
+                size += len(data)
+                if size > MAX_FILE_SIZE:
+                    raise _file_too_large()
+                hasher.update(data)
+                out.write(data)
+            pending.clear()
+        parser.finalize()
+        if out is None:
+            raise HTTPException(status_code=400, detail="No file provided")
+        out.close()
+    except BaseException as e:
+        if out is not None:
+            out.close()
+            os.remove(path)
+        if isinstance(e, HTTPException):
+            raise
+        if isinstance(e, Exception) and not isinstance(e, OSError):
+            raise HTTPException(status_code=400, detail=f"Invalid multipart upload: {str(e)}")
+        raise
+    return upload["filename"], upload["ext"], path, hasher.hexdigest()
+
+async def extract_with_cache(source: DocumentSource, file_ext: str, content_hash: Optional[str] = None) -> dict:
+    """Extract text and clauses from an upload, skipping DocumentProcessor for content seen before"""
+    if content_hash is None:
+        content_hash = hashlib.sha256(source).hexdigest()
+    cached = await extraction_cache.get(content_hash)
+    if cached is not None:
+        if cached.get("segmenter") == ClauseSegmenter.VERSION:
+            clauses = [Clause(*clause) for clause in cached["clauses"]]
+        else:
+            # Cached by an older segmenter
+            clauses = await asyncio.to_thread(clause_segmenter.segment, cached["text"])
+        return {"text": cached["text"], "clauses": clauses, "content_hash": content_hash, "cached": True}
+
+    text = await DocumentProcessor.extract_text(source, file_ext)
+    clauses = await asyncio.to_thread(clause_segmenter.segment, text)
+    await extraction_cache.put(content_hash, text, clauses)
+    return {"text": text, "clauses": clauses, "content_hash": content_hash, "cached": False}
+
+class RuleBasedSimplifier:
+    """Single-pass keyword simplifier compiled from per-language rule files
+
+    The phrases of a language are compiled into one alternation, longest phrase
+    first and anchored on word boundaries, so the text is scanned once no matter
+    how many rules there are. Matching runs case-sensitively over a lowercased copy
+    of the text, which is much cheaper than re.IGNORECASE; replacements follow the
+    case of the matched text. Languages without a rule file use the English rules.
+    """
+
+    def __init__(self, rules_dir: str, default_language: str = "en"):
+        self.rules_dir = rules_dir
+        self.default_language = default_language
+        self._compiled: Dict[str, Optional[Tuple["re.Pattern[str]", "re.Pattern[str]", Dict[str, str]]]] = {}
+
+    def _load(self, language: str) -> Optional[Tuple["re.Pattern[str]", "re.Pattern[str]", Dict[str, str]]]:
+        if language not in self._compiled:
+            path = os.path.join(self.rules_dir, f"{os.path.basename(language)}.json")
+            compiled = None
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    rules = {" ".join(phrase.lower().split()): replacement for phrase, replacement in json.load(f).items()}
+                rules.pop("", None)
+                if rules:
+                    alternation = "|".join(
+                        r"\s+".join(re.escape(word) for word in phrase.split())
+                        for phrase in sorted(rules, key=len, reverse=True)
+                    )
+                    pattern = rf"(?<!\w)(?:{alternation})(?!\w)"
+                    compiled = (re.compile(pattern), re.compile(pattern, re.IGNORECASE), rules)
+            self._compiled[language] = compiled
+        return self._compiled[language]
+
+    @staticmethod
+    def _match_case(matched: str, replacement: str) -> str:
+        if len(matched) > 1 and matched.isupper():
+            return replacement.upper()
+        if matched[0].isupper():
+            return replacement[:1].upper() + replacement[1:]
+        return replacement
+
+    def simplify(self, text: str, language: str = "en") -> str:
+        compiled = self._load(language) or self._load(self.default_language)
+        if compiled is None:
+            return text
+        pattern, pattern_ignorecase, rules = compiled
+
+        lowered = text.lower()
+        if len(lowered) == len(text):
+            matches = pattern.finditer(lowered)
+        else:
+            # A few characters change length when lowercased, so offsets would not line up
+            matches = pattern_ignorecase.finditer(text)
+
+        parts = []
+        last = 0
+        for match in matches:
+            start, end = match.span()
+            matched = text[start:end]
+            parts.append(text[last:start])
+            parts.append(self._match_case(matched, rules[" ".join(matched.lower().split())]))
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
+
+rule_simplifier = RuleBasedSimplifier(RULES_DIR)
+
+# Prompt budgeting
+class PromptBudget:
+    """Counts prompt tokens locally and fits prompts and replies into the model's context window
+
+    Tokens are counted with the model's tiktoken encoding when it can be loaded. Otherwise
+    they are estimated per script: about four ASCII characters per token, but roughly one
+    token per character for Devanagari and other non-Latin text. Counting never waits for
+    the tokenizer: until it has loaded in the background, the estimate is used.
+    """
+
+    # Tokens each chat message costs beyond its content, and the tokens that prime the reply
+    MESSAGE_OVERHEAD = 4
+    REPLY_OVERHEAD = 3
+
+    def __init__(self, model: str, context_window: int, fraction: float):
+        self.model = model
+        self.context_window = context_window
+        self.limit = int(context_window * fraction)
+        self._encoding = None
+        self._loaded = False
+        self._loading = False
+        self._load_lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.truncated = 0
+        self.recent_calls: deque = deque(maxlen=50)
+
+    def load(self):
+        """Load the tokenizer once; tiktoken may need to download its encoding on first use
+
+        Blocks, so call it from a worker thread.
+        """
+        self._loading = True
+        with self._load_lock:
+            if self._loaded:
+                return
+            if tiktoken is not None:
+                try:
+                    try:
+                        self._encoding = tiktoken.encoding_for_model(self.model)
+                    except KeyError:
+                        self._encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logger.warning(f"Tokenizer unavailable, estimating token counts instead: {e}")
+            self._loaded = True
+
+    def _ready(self) -> bool:
+        """Whether the tokenizer has loaded, starting the load in the background if nothing has"""
+        if self._loaded:
+            return True
+        if not self._loading:
+            self._loading = True
+            threading.Thread(target=self.load, name="tokenizer-load", daemon=True).start()
+        return False
+
+    def count(self, text: str) -> int:
+        if self._ready() and self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        return math.ceil(ascii_chars / 4) + len(text) - ascii_chars
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count(message["content"]) + self.MESSAGE_OVERHEAD for message in messages) + self.REPLY_OVERHEAD
+
+    def available(self, messages: List[Dict[str, str]], reply_tokens: int) -> int:
+        """Tokens left for content added to messages while keeping reply_tokens for the reply"""
+        return max(0, self.limit - self.count_messages(messages) - reply_tokens)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut text down to at most max_tokens tokens"""
+        if self._ready() and self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            self.truncated += 1
+            return self._encoding.decode(tokens[:max_tokens])
+
+        tokens = self.count(text)
+        if tokens <= max_tokens:
+            return text
+        self.truncated += 1
+        while tokens > max_tokens:
+            text = text[:max(0, len(text) * max_tokens // tokens - 1)]
+            tokens = self.count(text)
+        return text
+
+    def max_tokens_for(self, messages: List[Dict[str, str]], requested: int) -> Tuple[int, int]:
+        """Return (prompt tokens, max_tokens), shrinking max_tokens to what fits after the prompt
+
+        Raises ValueError when the prompt leaves no room for a reply, rather than letting
+        the API reject it with a context-length error.
+        """
+        prompt_tokens = self.count_messages(messages)
+        room = self.limit - prompt_tokens
+        if room <= 0:
+            raise ValueError(f"Prompt of {prompt_tokens} tokens exceeds the {self.limit}-token prompt budget")
+        return prompt_tokens, min(requested, room)
+
+    def record(self, prompt_tokens: int, completion_tokens: int, max_tokens: int):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.recent_calls.append({
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "max_tokens": max_tokens
+        })
+        logger.info(f"Model call: {prompt_tokens} prompt + {completion_tokens} completion tokens (max {max_tokens})")
+
+    def stats(self) -> Dict[str, Any]:
+        if self._encoding is not None:
+            tokenizer = f"tiktoken:{self._encoding.name}"
+        else:
+            tokenizer = "estimate" if self._loaded else "loading"
+        return {
+            "model": self.model,
+            "tokenizer": tokenizer,
+            "context_window": self.context_window,
+            "prompt_limit": self.limit,
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "truncated_inputs": self.truncated,
+            "recent_calls": list(self.recent_calls)
+        }
+
+prompt_budget = PromptBudget(OPENAI_MODEL, OPENAI_CONTEXT_WINDOW, PROMPT_CONTEXT_FRACTION)
+
+# Clause retrieval
+class LRUCache:
+    """Small in-process LRU map"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Any):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: str):
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+_STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just me more most my myself no nor not
+now of off on once only or other our ours ourselves out over own same she should so some such than that the
+their theirs them themselves then there these they this those through to too under until up very was we
+were what when where which while who whom why will with would you your yours yourself yourselves
+""".split())
+
+# Longest suffix first; a suffix is only stripped when at least three letters remain
+_SUFFIXES = ("ational", "ations", "ation", "ements", "ement", "ments", "ment", "ness", "ings", "ing",
+             "ities", "ity", "ies", "ied", "ers", "er", "ed", "es", "ly", "s")
+
+def _stem(word: str) -> str:
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            stem = word[:-len(suffix)]
+            return stem + "y" if suffix in ("ies", "ied", "ities") else stem
+    return word
+
+def tokenize_for_search(text: str) -> List[str]:
+    """Lowercase word tokens with stopwords removed and suffixes stemmed"""
+    return [_stem(word) for word in re.findall(r"\w+", text.lower())
+            if len(word) > 1 and word not in _STOPWORDS]
+
+class ClauseIndex:
+    """BM25 inverted index over the clauses of one document
+
+    A term's BM25 contribution to a clause doesn't depend on the query, so it is
+    computed once when the index is loaded and a query only sums precomputed weights.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, clauses: List[str], postings: Dict[str, List[Tuple[int, int]]]):
+        self.clauses = clauses
+        self.postings = postings
+        lengths = [0] * len(clauses)
+        for entries in postings.values():
+            for clause_id, frequency in entries:
+                lengths[clause_id] += frequency
+        average_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+        norms = [self.K1 * (1 - self.B + self.B * length / average_length) if average_length else self.K1
+                 for length in lengths]
+
+        count = len(clauses)
+        self.weights: Dict[str, List[Tuple[int, float]]] = {}
+        for term, entries in postings.items():
+            idf = math.log(1 + (count - len(entries) + 0.5) / (len(entries) + 0.5))
+            self.weights[term] = [
+                (clause_id, idf * frequency * (self.K1 + 1) / (frequency + norms[clause_id]))
+                for clause_id, frequency in entries
+            ]
+
+    @classmethod
+    def build(cls, clauses: List[str]) -> "ClauseIndex":
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for clause_id, clause in enumerate(clauses):
+            frequencies: Dict[str, int] = {}
+            for term in tokenize_for_search(clause):
+                frequencies[term] = frequencies.get(term, 0) + 1
+            for term, frequency in frequencies.items():
+                postings.setdefault(term, []).append((clause_id, frequency))
+        return cls(clauses, postings)
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[int, float]]:
+        """Return the top k (clause_id, score) pairs for a query"""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize_for_search(query)):
+            for clause_id, weight in self.weights.get(term, ()):
+                scores[clause_id] = scores.get(clause_id, 0.0) + weight
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def top_clauses(self, query: str, k: int = 3) -> List[str]:
+        return [self.clauses[clause_id] for clause_id, _ in self.search(query, k)]
+
+class ChunkVectorIndex:
+    """TF-IDF vectors of a document's chunks, stored per term as NumPy arrays
+
+    Each term maps to the chunks containing it and its L2-normalised TF-IDF weight in
+    each, so scoring a question is a handful of vectorised scatter-adds.
+    """
+
+    def __init__(self, chunks: List[str]):
+        self.chunks = chunks
+        self.token_counts = np.array([prompt_budget.count(chunk) for chunk in chunks], dtype=np.int64)
+
+        frequencies = []
+        document_frequency: Dict[str, int] = {}
+        for chunk in chunks:
+            counts: Dict[str, int] = {}
+            for term in tokenize_for_search(chunk):
+                counts[term] = counts.get(term, 0) + 1
+            frequencies.append(counts)
+            for term in counts:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+
+        count = len(chunks)
+        self.idf = {term: math.log((1 + count) / (1 + df)) + 1 for term, df in document_frequency.items()}
+
+        rows: Dict[str, List[int]] = {}
+        weights: Dict[str, List[float]] = {}
+        for row, counts in enumerate(frequencies):
+            vector = {term: frequency * self.idf[term] for term, frequency in counts.items()}
+            norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+            for term, value in vector.items():
+                rows.setdefault(term, []).append(row)
+                weights.setdefault(term, []).append(value / norm)
+        self._rows = {term: np.array(values, dtype=np.int64) for term, values in rows.items()}
+        self._weights = {term: np.array(values, dtype=np.float64) for term, values in weights.items()}
+
+    def scores(self, query: str) -> np.ndarray:
+        """Cosine similarity of every chunk to the query"""
+        scores = np.zeros(len(self.chunks))
+        counts: Dict[str, int] = {}
+        for term in tokenize_for_search(query):
+            if term in self.idf:
+                counts[term] = counts.get(term, 0) + 1
+        query_vector = {term: frequency * self.idf[term] for term, frequency in counts.items()}
+        norm = math.sqrt(sum(value * value for value in query_vector.values())) or 1.0
+        for term, value in query_vector.items():
+            np.add.at(scores, self._rows[term], self._weights[term] * (value / norm))
+        return scores
+
+    def pack(self, query: str, token_budget: int) -> str:
+        """Join the best-matching chunks that fit in token_budget, in document order
+
+        With no matching chunk at all (e.g. "summarise this"), the document is packed from the start.
+        """
+        scores = self.scores(query)
+        order = [row for row in np.argsort(-scores, kind="stable") if scores[row] > 0]
+        if not order:
+            order = range(len(self.chunks))
+
+        selected = []
+        used = 0
+        for row in order:
+            tokens = int(self.token_counts[row])
+            if used + tokens > token_budget:
+                continue
+            selected.append(row)
+            used += tokens
+        return "\n...\n".join(self.chunks[row] for row in sorted(selected))
+
+chat_context_indexes = LRUCache(CLAUSE_INDEX_CACHE_SIZE)
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key onto one in-flight task
+
+    Each caller awaits the shared task through asyncio.shield, so a caller going away
+    never cancels the work for the others; the task is cancelled only when its last
+    waiter is.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Nobody is left to use the result; later callers start a fresh flight
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced
+        }
+
+# Model call flow control
+class ModelUnavailableError(Exception):
+    """A model call was shed (circuit open, queue full or deadline unreachable) or ran out of retries"""
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for model calls
+
+    Every success while the limit is saturated adds 1/limit, about one slot per round
+    of calls. A rate-limit response, or a call slower than the latency target, cuts the
+    limit multiplicatively, at most once per round trip so a burst of 429s from one
+    window counts once. Waiters are shed early when the queue is full or the expected
+    wait already exceeds their deadline.
+    """
+
+    BACKOFF = 0.5
+    SLOW_BACKOFF = 0.9
+
+    def __init__(self, initial: int, minimum: int, maximum: int, max_queue: int, latency_target: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.max_queue = max_queue
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency: Optional[float] = None
+        self._waiters: deque = deque()
+        self._last_decrease = 0.0
+        self.successes = 0
+        self.rate_limited = 0
+        self.slow = 0
+        self.shed = 0
+
+    @property
+    def capacity(self) -> int:
+        return int(self.limit)
+
+    async def acquire(self, timeout: float):
+        if self.waiting == 0 and self.in_flight < self.capacity:
+            self.in_flight += 1
+            return
+        if self.waiting >= self.max_queue:
+            self.shed += 1
+            raise ModelUnavailableError("Model call queue is full")
+        if self.latency is not None and (self.waiting + 1) / self.capacity * self.latency > timeout:
+            self.shed += 1
+            raise ModelUnavailableError("Model call would not start before its deadline")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), max(0.0, timeout))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we gave up on it
+                self.release()
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed += 1
+                raise ModelUnavailableError("Timed out waiting for a model call slot")
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._grant()
+
+    def _grant(self):
+        while self._waiters and self.in_flight < self.capacity:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self._last_decrease >= (self.latency or 1.0):
+            self.limit = max(float(self.minimum), self.limit * factor)
+            self._last_decrease = now
+
+    def on_success(self, latency: float):
+        self.successes += 1
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if latency > self.latency_target:
+            self.slow += 1
+            self._decrease(self.SLOW_BACKOFF)
+        elif self.in_flight >= self.capacity:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._grant()
+
+    def on_rate_limited(self):
+        self.rate_limited += 1
+        self._decrease(self.BACKOFF)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "latency_seconds": round(self.latency, 3) if self.latency is not None else None,
+            "successes": self.successes,
+            "rate_limited": self.rate_limited,
+            "slow": self.slow,
+            "shed": self.shed
+        }
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failed calls; open -> half-open after reset_seconds
+
+    While open every call is rejected immediately. Half-open lets a single probe through:
+    its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probing = False
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                self.rejected += 1
+                raise ModelUnavailableError("Model API circuit is open")
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            if self._probing:
+                self.rejected += 1
+                raise ModelUnavailableError("Model API circuit is half-open and probing")
+            self._probing = True
+
+    def on_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probing = False
+
+    def on_failure(self):
+        self.consecutive_failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+                logger.warning(f"Model API circuit opened after {self.consecutive_failures} failed calls")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """A call ended without telling us anything about the API (shed or cancelled)"""
+        self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+# Failures worth retrying: rate limits, timeouts, connection errors and 5xx responses
+_RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                     openai.error.ServiceUnavailableError, openai.error.TryAgain, asyncio.TimeoutError)
+
+def _is_retryable(e: BaseException) -> bool:
+    if isinstance(e, _RETRYABLE_ERRORS):
+        return True
+    return isinstance(e, openai.error.APIError) and (e.http_status or 500) >= 500
+
+def _retry_after(e: BaseException) -> float:
+    try:
+        return float(e.headers.get("retry-after", 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+class ModelClient:
+    """openai.ChatCompletion.acreate behind the adaptive limiter, retries and circuit breaker
+
+    Each call gets OPENAI_DEADLINE_SECONDS for queueing, attempts and backoff together.
+    Retries sleep a full-jitter exponential backoff (never less than the API's Retry-After)
+    and stop once the next attempt could not finish before the deadline.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, breaker: CircuitBreaker, deadline: float):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.deadline = deadline
+        self.retries = 0
+        self.failures = 0
+
+    async def create(self, **kwargs) -> Any:
+        response = await self._call(
+            lambda timeout: asyncio.wait_for(openai.ChatCompletion.acreate(**kwargs), timeout)
+        )
+        self.limiter.release()
+        return response
+
+    async def stream(self, **kwargs) -> AsyncIterator[Any]:
+        """Yield stream chunks; only starting the stream (up to its first chunk) is retried"""
+        async def start(timeout: float):
+            started = time.monotonic()
+            response = await asyncio.wait_for(openai.ChatCompletion.acreate(stream=True, **kwargs), timeout)
+            try:
+                first = await asyncio.wait_for(response.__anext__(), timeout - (time.monotonic() - started))
+            except StopAsyncIteration:
+                first = None
+            return response, first
+
+        response, first = await self._call(start)
+        try:
+            if first is None:
+                return
+            yield first
+            async for chunk in response:
+                yield chunk
+        finally:
+            self.limiter.release()
+
+    async def _call(self, attempt: Callable[[float], Awaitable[Any]]) -> Any:
+        """Run attempt(timeout) until it succeeds; on success the caller owns a limiter slot"""
+        self.breaker.allow()
+        deadline = time.monotonic() + self.deadline
+        retry = 0
+        outcome_known = False
+        try:
+            while True:
+                await self.limiter.acquire(deadline - time.monotonic())
+                started = time.monotonic()
+                try:
+                    result = await attempt(deadline - started)
+                except asyncio.CancelledError:
+                    self.limiter.release()
+                    raise
+                except Exception as e:
+                    self.limiter.release()
+                    if not _is_retryable(e):
+                        # The API answered, it just refused this request
+                        outcome_known = True
+                        self.breaker.on_success()
+                        raise
+                    if isinstance(e, openai.error.RateLimitError):
+                        self.limiter.on_rate_limited()
+                    delay = max(_retry_after(e),
+                                random.uniform(0, min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2 ** retry)))
+                    if time.monotonic() + delay >= deadline:
+                        outcome_known = True
+                        self.failures += 1
+                        self.breaker.on_failure()
+                        raise ModelUnavailableError(f"Model call failed after {retry + 1} attempts: {e}") from e
+                    retry += 1
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+                    continue
+
+                outcome_known = True
+                self.limiter.on_success(time.monotonic() - started)
+                self.breaker.on_success()
+                return result
+        finally:
+            if not outcome_known:
+                self.breaker.abandon()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limiter": self.limiter.stats(),
+            "circuit": self.breaker.stats(),
+            "retries": self.retries,
+            "failures": self.failures
+        }
+
+model_client = ModelClient(
+    AdaptiveLimiter(OPENAI_INITIAL_CONCURRENCY, OPENAI_MIN_CONCURRENCY, OPENAI_MAX_CONCURRENCY,
+                    OPENAI_MAX_QUEUE, OPENAI_LATENCY_TARGET_SECONDS),
+    CircuitBreaker(OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_RESET_SECONDS),
+    OPENAI_DEADLINE_SECONDS
+)
+
+class AIService:
+    def __init__(self):
+        openai.api_key = OPENAI_API_KEY
+        self._in_flight = SingleFlight()
+
+    async def simplify_legal_text(self, text: str, language: str = "en", complexity: str = "simple") -> str:
+        """Simplify legal text using AI
+
+        Text longer than one prompt's worth of tokens is split on clause boundaries, the
+        chunks are simplified concurrently and the sections are merged in document order.
+        """
+        chunks = await self._simplification_chunks(text, language, complexity)
+        if len(chunks) <= 1:
+            return await self._simplify_chunk(text, language, complexity)
+
+        sections = [None] * len(chunks)
+        async for index, _, section in self.simplify_legal_text_stream(text, language, complexity, chunks):
+            sections[index] = section
+        return "\n\n".join(sections)
+
+    async def simplify_legal_text_stream(self, text: str, language: str = "en", complexity: str = "simple",
+                                         chunks: Optional[List[str]] = None) -> AsyncIterator[Tuple[int, int, str]]:
+        """Yield (index, total, section) for each chunk as soon as its simplification finishes"""
+        if chunks is None:
+            chunks = await self._simplification_chunks(text, language, complexity)
+        total = len(chunks)
+        semaphore = asyncio.Semaphore(SIMPLIFY_MAX_CONCURRENCY)
+
+        async def simplify_section(index: int, chunk: str) -> Tuple[int, str]:
+            async with semaphore:
+                part = (index + 1, total) if total > 1 else None
+                return index, await self._simplify_chunk(chunk, language, complexity, part)
+
+        tasks = [asyncio.ensure_future(simplify_section(i, chunk)) for i, chunk in enumerate(chunks)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                index, section = await finished
+                yield index, total, section
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _simplify_chunk(self, text: str, language: str, complexity: str,
+                              part: Optional[Tuple[int, int]] = None) -> str:
+        """Simplify a single chunk with one model call"""
+        try:
+            return await self._chat_completion(
+                messages=self._simplification_messages(text, language, complexity, part),
+                max_tokens=SIMPLIFY_MAX_OUTPUT_TOKENS,
+                temperature=0.3
+            )
+        except Exception as e:
+            # Fallback to rule-based simplification if AI fails
+            return self.rule_based_simplification(text, language)
+
+    async def simplify_document(self, text: str, language: str = "en", complexity: str = "simple",
+                                clauses: Optional[List[Clause]] = None) -> str:
+        """Simplify a document clause by clause, reusing what earlier documents already simplified
+
+        Clauses are matched across documents on their normalized text (case, whitespace and
+        numbering don't matter) for the same language and complexity, so shared boilerplate
+        is only ever simplified once. The clauses nobody has seen go to the model, several
+        to a prompt. Headings are kept as they are.
+        """
+        if clauses is None:
+            clauses = await asyncio.to_thread(clause_segmenter.segment, text)
+
+        keys, unseen = await asyncio.to_thread(self._clause_keys, text, clauses, language, complexity)
+
+        simplified = await clause_simplifications.get_many(list(unseen))
+        for key in simplified:
+            del unseen[key]
+        if unseen:
+            simplified.update(await self._simplify_clauses(unseen, language, complexity))
+        return self._assemble_clauses(text, clauses, keys, simplified)
+
+    async def _simplify_clauses(self, bodies: Dict[str, str], language: str, complexity: str) -> Dict[str, str]:
+        """Simplify unseen clauses (key -> text) in batches that each fit one prompt, caching the results
+
+        A clause too long for a prompt of its own is split on words like _chunk_text does, and its
+        parts are simplified separately and joined again. Only clauses the model simplified in full
+        are cached; one with any part left to the rule-based fallback is simplified again next time.
+        """
+        template = self._clause_messages([], language, complexity)
+        budget = max(1, min(SIMPLIFY_CHUNK_TOKENS, prompt_budget.available(template, SIMPLIFY_MAX_OUTPUT_TOKENS)))
+        parts, batches = await asyncio.to_thread(self._plan_clause_batches, bodies, budget)
+
+        semaphore = asyncio.Semaphore(SIMPLIFY_MAX_CONCURRENCY)
+        sections: Dict[Tuple[str, int], str] = {}
+
+        async def simplify_batch(batch: List[Tuple[Tuple[str, int], str]]):
+            async with semaphore:
+                sections.update(await self._simplify_clause_batch(batch, language, complexity))
+
+        await asyncio.gather(*(simplify_batch(batch) for batch in batches))
+
+        results: Dict[str, str] = {}
+        cacheable: Dict[str, str] = {}
+        for key, pieces in parts.items():
+            simplified = [sections.get((key, index)) for index in range(len(pieces))]
+            if all(section is not None for section in simplified):
+                results[key] = cacheable[key] = " ".join(simplified)
+            else:
+                results[key] = " ".join(section if section is not None else rule_simplifier.simplify(piece, language)
+                                        for section, piece in zip(simplified, pieces))
+        await clause_simplifications.set_many(cacheable)
+        return results
+
+    @staticmethod
+    def _clause_keys(text: str, clauses: List[Clause], language: str,
+                     complexity: str) -> Tuple[List[Optional[str]], Dict[str, str]]:
+        """The cache key of each clause (None for headings and empty clauses) and the text of each key"""
+        keys: List[Optional[str]] = []
+        bodies: Dict[str, str] = {}
+        for clause in clauses:
+            body = " ".join(clause_segmenter.body(text, clause)[0].split())
+            if clause.kind != "clause" or not body:
+                keys.append(None)
+                continue
+            key = ClauseSimplificationCache.make_key(language, complexity, ClauseSegmenter.normalize(body))
+            keys.append(key)
+            bodies.setdefault(key, body)
+        return keys, bodies
+
+    def _plan_clause_batches(self, bodies: Dict[str, str], budget: int
+                             ) -> Tuple[Dict[str, List[str]], List[List[Tuple[Tuple[str, int], str]]]]:
+        """Split each clause into parts that fit the budget and pack the parts into batches
+
+        Returns the parts of each clause and the batches of ((key, part index), part).
+        """
+        parts: Dict[str, List[str]] = {}
+        batches: List[List[Tuple[Tuple[str, int], str]]] = [[]]
+        used = 0
+        for key, body in bodies.items():
+            tokens = prompt_budget.count(body)
+            if tokens <= budget:
+                pieces = [(body, tokens)]
+            else:
+                pieces = [(part, prompt_budget.count(part))
+                          for part in self._chunk_text(body, budget, [Clause(0, len(body), "clause", None)])]
+            parts[key] = [part for part, _ in pieces]
+            for index, (part, tokens) in enumerate(pieces):
+                if batches[-1] and (used + tokens > budget or len(batches[-1]) >= CLAUSE_BATCH_MAX_CLAUSES):
+                    batches.append([])
+                    used = 0
+                batches[-1].append(((key, index), part))
+                used += tokens
+        return parts, batches
+
+    async def _simplify_clause_batch(self, batch: List[Tuple[Tuple[str, int], str]], language: str,
+                                     complexity: str) -> Dict[Tuple[str, int], str]:
+        """Simplify one batch with one model call
+
+        A reply that isn't one string per clause is retried a clause at a time. Clauses the
+        model couldn't simplify are left out of the result.
+        """
+        try:
+            reply = await self._chat_completion(
+                messages=self._clause_messages([body for _, body in batch], language, complexity),
+                max_tokens=SIMPLIFY_MAX_OUTPUT_TOKENS,
+                temperature=0.3
+            )
+        except Exception:
+            return {}
+
+        sections = self._parse_clause_reply(reply, len(batch))
+        if sections is None:
+            if len(batch) > 1:
+                results: Dict[Tuple[str, int], str] = {}
+                for item in batch:
+                    results.update(await self._simplify_clause_batch([item], language, complexity))
+                return results
+            sections = [reply.strip()]
+
+        return {item: section for (item, _), section in zip(batch, sections)}
+
+    @staticmethod
+    def _parse_clause_reply(reply: str, count: int) -> Optional[List[str]]:
+        """The reply's JSON array of count strings, or None if it isn't one"""
+        reply = reply.strip()
+        if reply.startswith("```"):
+            reply = reply.strip("`").partition("\n")[2]
+        try:
+            sections = json.loads(reply)
+        except ValueError:
+            return None
+        if not isinstance(sections, list) or len(sections) != count or not all(isinstance(s, str) for s in sections):
+            return None
+        return [section.strip() for section in sections]
+
+    def _clause_messages(self, bodies: List[str], language: str, complexity: str) -> List[Dict[str, str]]:
+        numbered = "\n".join(f"[{index}] {body}" for index, body in enumerate(bodies, 1))
+        prompt = f"""
+        {self.LANGUAGE_PROMPTS.get(language, self.LANGUAGE_PROMPTS["en"])}.
+        
+        {self.COMPLEXITY_LEVELS.get(complexity, self.COMPLEXITY_LEVELS["simple"])}.
+        
+        Below are numbered clauses taken from legal documents. Simplify each clause on its own:
+        explain what it means in practical terms and keep its rights and obligations.
+        
+        Reply with only a JSON array of {len(bodies)} strings, the simplified clauses in the same order.
+        
+        Clauses:
+        {numbered}
+        """
+
+        return [
+            {"role": "system", "content": "You are a legal expert who specializes in simplifying complex legal documents for ordinary people."},
+            {"role": "user", "content": prompt}
+        ]
+
+    @staticmethod
+    def _assemble_clauses(text: str, clauses: List[Clause], keys: List[Optional[str]],
+                          simplified: Dict[str, str]) -> str:
+        """Lay the simplified clauses out like the original
+
+        Headings and numbered clauses start new lines, as do paragraphs; the other
+        clauses of a paragraph follow on the same line.
+        """
+        lines: List[str] = []
+        previous: Optional[Clause] = None
+        for clause, key in zip(clauses, keys):
+            if key is None:
+                lines.append(text[clause.start:clause.end])
+            else:
+                section = simplified[key]
+                numbered = clause_segmenter.body(text, clause)[1]
+                if numbered:
+                    lines.append(f"{clause.number} {section}" if clause.number else section)
+                elif (previous is not None and previous.kind == "clause"
+                      and text.count("\n", previous.end, clause.start) < 2):
+                    lines[-1] += " " + section
+                else:
+                    lines.append(section)
+            previous = clause
+        return "\n".join(lines)
+
+    async def stream_simplify(self, text: str, language: str = "en", complexity: str = "simple") -> AsyncIterator[str]:
+        """Yield the simplification incrementally
+
+        Short text is streamed token by token. Long text is map-reduced as in
+        simplify_legal_text and each section is yielded as soon as every section
+        before it is done.
+        """
+        chunks = await self._simplification_chunks(text, language, complexity)
+        if len(chunks) <= 1:
+            started = False
+            try:
+                async for token in self._stream_completion(
+                    self._simplification_messages(text, language, complexity),
+                    max_tokens=SIMPLIFY_MAX_OUTPUT_TOKENS, temperature=0.3
+                ):
+                    started = True
+                    yield token
+            except Exception:
+                if started:
+                    raise
+                yield self.rule_based_simplification(text, language)
+            return
+
+        pending: Dict[int, str] = {}
+        next_index = 0
+        async for index, total, section in self.simplify_legal_text_stream(text, language, complexity, chunks):
+            pending[index] = section
+            while next_index in pending:
+                yield ("\n\n" if next_index else "") + pending.pop(next_index)
+                next_index += 1
+
+    async def _simplification_chunks(self, text: str, language: str, complexity: str) -> List[str]:
+        """Split text into chunks that each fit one simplification prompt along with its reply"""
+        template = self._simplification_messages("", language, complexity, (1, 1))
+        budget = min(SIMPLIFY_CHUNK_TOKENS, prompt_budget.available(template, SIMPLIFY_MAX_OUTPUT_TOKENS))
+        return await asyncio.to_thread(self._chunk_text, text, max(1, budget))
+
+    LANGUAGE_PROMPTS = {
+        "en": "Simplify this legal document into plain English",
+        "hi": "इस कानूनी दस्तावेज़ को सरल हिंदी में समझाएं",
+        "mr": "या कायदेशीर कागदपत्राचे मराठीत सोप्या भाषेत स्पष्टीकरण द्या"
+    }
+
+    COMPLEXITY_LEVELS = {
+        "simple": "Use very simple language that a 12-year-old could understand",
+        "intermediate": "Use clear language suitable for high school graduates",
+        "advanced": "Use professional but clear language suitable for college graduates"
+    }
+
+    def _simplification_messages(self, text: str, language: str, complexity: str,
+                                 part: Optional[Tuple[int, int]] = None) -> List[Dict[str, str]]:
+        language_prompts = self.LANGUAGE_PROMPTS
+        complexity_levels = self.COMPLEXITY_LEVELS
+
+        section_note = ""
+        if part:
+            section_note = f"This is section {part[0]} of {part[1]} of a longer document. Simplify only this section."
+
+        prompt = f"""
+        {language_prompts.get(language, language_prompts["en"])}.
+        
+        {complexity_levels.get(complexity, complexity_levels["simple"])}.
+        {section_note}
+        
+        Please:
+        1. Break down complex legal terms into simple explanations
+        2. Explain what each clause means in practical terms
+        3. Highlight key rights and obligations
+        4. Use bullet points for clarity
+        5. Maintain the document structure but make it readable
+        
+        Original legal text:
+        {prompt_budget.truncate(text, SIMPLIFY_CHUNK_TOKENS)}
+        """
+
+        return [
+            {"role": "system", "content": "You are a legal expert who specializes in simplifying complex legal documents for ordinary people."},
+            {"role": "user", "content": prompt}
+        ]
+
+    async def _chat_completion(self, messages: List[Dict[str, str]], max_tokens: int, temperature: float) -> str:
+        """Run a chat completion, answering from the response cache when possible
+
+        Identical requests that miss the cache at the same time share a single model call.
+        max_tokens is shrunk to whatever the prompt leaves of the context budget.
+        """
+        prompt_tokens, max_tokens = prompt_budget.max_tokens_for(messages, max_tokens)
+        key = ResponseCache.make_key(OPENAI_MODEL, temperature, max_tokens, messages)
+        cached = await response_cache.get(key)
+        if cached is not None:
+            return cached
+
+        return await self._in_flight.do(
+            key, lambda: self._complete_and_cache(key, messages, prompt_tokens, max_tokens, temperature)
+        )
+
+    async def _complete_and_cache(self, key: str, messages: List[Dict[str, str]], prompt_tokens: int,
+                                  max_tokens: int, temperature: float) -> str:
+        response = await model_client.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        content = response.choices[0].message.content
+        # Prefer the API's own usage figures; count locally when they're missing
+        usage = getattr(response, "usage", None) or {}
+        prompt_budget.record(
+            usage.get("prompt_tokens", prompt_tokens),
+            usage.get("completion_tokens") or prompt_budget.count(content),
+            max_tokens
+        )
+        await response_cache.set(key, content)
+        return content
+
+    async def _stream_completion(self, messages: List[Dict[str, str]], max_tokens: int,
+                                 temperature: float) -> AsyncIterator[str]:
+        """Yield completion tokens as they arrive
+
+        A cached response is yielded in one piece; a streamed response is cached
+        only once it has been received in full.
+        """
+        prompt_tokens, max_tokens = prompt_budget.max_tokens_for(messages, max_tokens)
+        key = ResponseCache.make_key(OPENAI_MODEL, temperature, max_tokens, messages)
+        cached = await response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        async for chunk in model_client.stream(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        ):
+            token = chunk.choices[0].delta.get("content")
+            if token:
+                parts.append(token)
+                yield token
+        content = "".join(parts)
+        prompt_budget.record(prompt_tokens, prompt_budget.count(content), max_tokens)
+        await response_cache.set(key, content)
+
+    def _chunk_text(self, text: str, max_tokens: int, clauses: Optional[List[Clause]] = None) -> List[str]:
+        """Split text into chunks of at most max_tokens tokens, breaking between clauses
+
+        Uses the document's stored clauses when given them, otherwise segments the text.
+        A chunk's size is taken as the sum of its pieces' token counts, which is close to
+        (and rarely below) the count of the joined text.
+        """
+        if clauses is None:
+            clauses = clause_segmenter.segment(text)
+        chunks = []
+        current: List[str] = []
+        used = 0
+
+        def add(piece: str, tokens: int):
+            nonlocal used
+            if current and used + tokens > max_tokens:
+                chunks.append(" ".join(current))
+                current.clear()
+                used = 0
+            current.append(piece)
+            used += tokens
+
+        for span in clauses:
+            clause = text[span.start:span.end]
+            tokens = prompt_budget.count(clause)
+            if tokens <= max_tokens:
+                add(clause, tokens)
+                continue
+
+            # A single clause longer than a chunk falls back to splitting on words
+            for word in clause.split():
+                add(word, prompt_budget.count(" " + word))
+
+        if current:
+            chunks.append(" ".join(current))
+        return chunks
+
+    def rule_based_simplification(self, text: str, language: str) -> str:
+        """Fallback rule-based simplification"""
+        return f"Simplified version: {rule_simplifier.simplify(text, language)}"
+
+    async def answer_question(self, question: str, document_text: str, language: str = "en",
+                              clause_index: Optional[ClauseIndex] = None,
+                              clauses: Optional[List[Clause]] = None) -> dict:
+        """Answer questions about the document"""
+        try:
+            context = await self.build_chat_context(question, document_text, language, clauses)
+            answer = await self._chat_completion(
+                messages=self._question_messages(question, context, language),
+                max_tokens=CHAT_MAX_OUTPUT_TOKENS,
+                temperature=0.2
+            )
+            
+            return {
+                "response": answer,
+                "confidence": 0.85,
+                "relevant_clauses": self.extract_relevant_clauses(document_text, question, clause_index)
+            }
+        except Exception as e:
+            return self.error_answer(e)
+
+    async def stream_answer(self, question: str, document_text: str, language: str = "en",
+                            clauses: Optional[List[Clause]] = None) -> AsyncIterator[str]:
+        """Yield the answer token by token"""
+        context = await self.build_chat_context(question, document_text, language, clauses)
+        async for token in self._stream_completion(
+            self._question_messages(question, context, language), max_tokens=CHAT_MAX_OUTPUT_TOKENS, temperature=0.2
+        ):
+            yield token
+
+    def error_answer(self, e: Exception) -> dict:
+        return {
+            "response": f"I apologize, but I encountered an error processing your question: {str(e)}. Please try rephrasing your question or contact support.",
+            "confidence": 0.0,
+            "relevant_clauses": []
+        }
+
+    async def build_chat_context(self, question: str, document_text: str, language: str = "en",
+                                 clauses: Optional[List[Clause]] = None) -> str:
+        """Pick the parts of the document that answer the question
+
+        The context gets CHAT_CONTEXT_TOKEN_BUDGET tokens, or less when the question and
+        the reply wouldn't otherwise fit in the context window.
+        """
+        template = self._question_messages(question, "", language)
+        budget = min(CHAT_CONTEXT_TOKEN_BUDGET, prompt_budget.available(template, CHAT_MAX_OUTPUT_TOKENS))
+        # Text runs about four characters per token; past eight it goes to retrieval uncounted
+        if len(document_text) <= 8 * budget and prompt_budget.count(document_text) <= budget:
+            return document_text
+
+        key = hashlib.sha256(document_text.encode('utf-8')).hexdigest()
+        index = chat_context_indexes.get(key)
+        if index is None:
+            index = await asyncio.to_thread(
+                lambda: ChunkVectorIndex(self._chunk_text(document_text, CHAT_CONTEXT_CHUNK_TOKENS, clauses))
+            )
+            chat_context_indexes.put(key, index)
+        return index.pack(question, budget)
+
+    def _question_messages(self, question: str, context: str, language: str) -> List[Dict[str, str]]:
+        prompt = f"""
+        Based on the following legal document, please answer this question: {question}
+        
+        Document content (the excerpts most relevant to the question, in document order):
+        {context}
+        
+        Please provide:
+        1. A clear, direct answer
+        2. Reference to specific clauses if applicable
+        3. Practical implications
+        4. Any important warnings or considerations
+        
+        Answer in {language} language.
+        """
+
+        return [
+            {"role": "system", "content": "You are a helpful legal assistant. Provide accurate information based on the document, but always remind users to consult a lawyer for official legal advice."},
+            {"role": "user", "content": prompt}
+        ]
+
+    def extract_relevant_clauses(self, text: str, question: str,
+                                 clause_index: Optional[ClauseIndex] = None) -> List[str]:
+        """Extract the clauses most relevant to the question by BM25
+
+        Uses the document's stored index when given one, otherwise indexes the text on the fly.
+        """
+        if clause_index is None:
+            clause_index = ClauseIndex.build(ClauseSegmenter.texts(text, clause_segmenter.segment(text)))
+        return clause_index.top_clauses(question, 3)
+
+# Database helper functions
+class Database:
+    """Connection pool that lives for the app's lifetime
+
+    Reads borrow one of a fixed set of connections; in WAL mode they never wait for a
+    writer. All writes go through one connection behind a lock, so transactions are
+    serialized in-process instead of contending for SQLite's write lock. Each connection
+    keeps its own cache of prepared statements.
+    """
+
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        f'PRAGMA mmap_size={DB_MMAP_SIZE}',
+        f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA busy_timeout=5000'
+    )
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._read_pool: Optional[asyncio.Queue] = None
+        self._connections: List[aiosqlite.Connection] = []
+        self._open_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.write_waiters = 0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE_SIZE)
+        conn.row_factory = aiosqlite.Row
+        await conn.create_function('decompress_text', 1, decompress_text, deterministic=True)
+        for pragma in self.PRAGMAS:
+            await conn.execute(pragma)
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            read_pool = asyncio.Queue()
+            for _ in range(self.readers):
+                read_pool.put_nowait(await self._connect())
+            self._read_pool = read_pool
+            self._writer = await self._connect()
+
+    async def close(self):
+        async with self._open_lock:
+            for conn in self._connections:
+                await conn.close()
+            self._connections = []
+            self._writer = None
+            self._read_pool = None
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        if self._writer is None:
+            await self.open()
+        conn = await self._read_pool.get()
+        self.reads += 1
+        try:
+            yield conn
+        finally:
+            self._read_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Run a write transaction; it commits when the block exits and rolls back on error"""
+        if self._writer is None:
+            await self.open()
+        self.write_waiters += 1
+        try:
+            await self._write_lock.acquire()
+        finally:
+            self.write_waiters -= 1
+        try:
+            self.writes += 1
+            try:
+                yield self._writer
+            except BaseException:
+                await asyncio.shield(self._writer.rollback())
+                raise
+            await asyncio.shield(self._writer.commit())
+        finally:
+            self._write_lock.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "open": self._writer is not None,
+            "read_connections": self.readers,
+            "idle_read_connections": self._read_pool.qsize() if self._read_pool is not None else 0,
+            "reads": self.reads,
+            "writes": self.writes,
+            "write_waiters": self.write_waiters
+        }
+
+db = Database(DATABASE_PATH, DB_READ_CONNECTIONS)
+
+# Document statistics
+class DocumentStatistics:
+    """Running /stats aggregates in the single-row document_stats table
+
+    Every document insert or delete applies its delta to the row inside the same write
+    transaction, so /stats is one primary-key read. A background task recomputes the
+    aggregates from the documents table now and then to correct any drift (rows
+    written by other tools, or written before the table existed).
+    """
+
+    APPLY_SQL = '''
+        UPDATE document_stats SET
+            total_documents = total_documents + :sign,
+            completed_documents = completed_documents + :completed * :sign,
+            total_words = total_words + :completed * :sign * :words,
+            total_processing_time = total_processing_time + :completed * :sign * :seconds,
+            language_distribution = CASE
+                WHEN COALESCE(json_extract(language_distribution, :language), 0) + :sign <= 0
+                THEN json_remove(language_distribution, :language)
+                ELSE json_set(language_distribution, :language,
+                              COALESCE(json_extract(language_distribution, :language), 0) + :sign)
+            END,
+            status_distribution = CASE
+                WHEN COALESCE(json_extract(status_distribution, :status), 0) + :sign <= 0
+                THEN json_remove(status_distribution, :status)
+                ELSE json_set(status_distribution, :status,
+                              COALESCE(json_extract(status_distribution, :status), 0) + :sign)
+            END,
+            updated_at = :now
+        WHERE id = 1
+    '''
+
+    def __init__(self, reconcile_interval: float):
+        self.reconcile_interval = reconcile_interval
+        self._task: Optional[asyncio.Task] = None
+        self.reconciles = 0
+        self.corrections = 0
+
+    @staticmethod
+    def _path(key: Optional[str]) -> str:
+        # JSON path of a distribution key; None is stored as "null", as json.dumps would
+        return '$.' + json.dumps("null" if key is None else str(key))
+
+    async def apply(self, conn: aiosqlite.Connection, language: Optional[str], status: Optional[str],
+                    word_count: Optional[int], processing_time: Optional[float], sign: int):
+        """Add (sign=1) or remove (sign=-1) one document; call inside the document's write transaction"""
+        await conn.execute(self.APPLY_SQL, {
+            "sign": sign,
+            "completed": 1 if status == "completed" else 0,
+            "words": word_count or 0,
+            "seconds": processing_time or 0,
+            "language": self._path(language),
+            "status": self._path(status),
+            "now": datetime.now().isoformat()
+        })
+
+    async def get(self) -> dict:
+        async with db.read() as conn:
+            cursor = await conn.execute('SELECT * FROM document_stats WHERE id = 1')
+            row = await cursor.fetchone()
+        completed = row['completed_documents']
+        return {
+            "total_documents_processed": row['total_documents'],
+            "total_words_processed": row['total_words'],
+            "average_processing_time_seconds": round(row['total_processing_time'] / completed, 2) if completed else 0,
+            "language_distribution": json.loads(row['language_distribution']),
+            "status_distribution": json.loads(row['status_distribution'])
+        }
+
+    async def reconcile(self) -> bool:
+        """Recompute the aggregates from the documents table; return whether they had drifted"""
+        async with db.write() as conn:
+            cursor = await conn.execute('''
+                SELECT COUNT(*),
+                       COALESCE(SUM(status = 'completed'), 0),
+                       COALESCE(SUM(CASE WHEN status = 'completed' THEN word_count END), 0),
+                       COALESCE(SUM(CASE WHEN status = 'completed' THEN processing_time END), 0)
+                FROM documents
+            ''')
+            totals = tuple(await cursor.fetchone())
+            cursor = await conn.execute('SELECT language, COUNT(*) FROM documents GROUP BY language')
+            languages = {("null" if language is None else language): count for language, count in await cursor.fetchall()}
+            cursor = await conn.execute('SELECT status, COUNT(*) FROM documents GROUP BY status')
+            statuses = {("null" if status is None else status): count for status, count in await cursor.fetchall()}
+
+            cursor = await conn.execute('''
+                SELECT total_documents, completed_documents, total_words, total_processing_time,
+                       language_distribution, status_distribution
+                FROM document_stats WHERE id = 1
+            ''')
+            current = await cursor.fetchone()
+            drifted = (
+                tuple(current)[:3] != totals[:3]
+                or not math.isclose(current['total_processing_time'], totals[3], abs_tol=1e-6)
+                or json.loads(current['language_distribution']) != languages
+                or json.loads(current['status_distribution']) != statuses
+            )
+            now = datetime.now().isoformat()
+            if drifted:
+                await conn.execute('''
+                    UPDATE document_stats SET
+                        total_documents = ?, completed_documents = ?, total_words = ?, total_processing_time = ?,
+                        language_distribution = ?, status_distribution = ?, updated_at = ?, reconciled_at = ?
+                    WHERE id = 1
+                ''', (*totals, json.dumps(languages), json.dumps(statuses), now, now))
+            else:
+                await conn.execute('UPDATE document_stats SET reconciled_at = ? WHERE id = 1', (now,))
+
+        self.reconciles += 1
+        if drifted:
+            self.corrections += 1
+            logger.warning("Document statistics had drifted and were recomputed")
+        return drifted
+
+    async def _reconcile_loop(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Error reconciling document statistics: {str(e)}")
+            await asyncio.sleep(self.reconcile_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._reconcile_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "reconciles": self.reconciles,
+            "corrections": self.corrections
+        }
+
+document_stats = DocumentStatistics(STATS_RECONCILE_INTERVAL)
+
+async def save_document_to_db(document_data: dict, clauses: Optional[List[Clause]] = None):
+    """Store a document, along with its clauses and their index when given them
+
+    Replaces whatever was stored under the same id, so a retried job can save again.
+    """
+    original, simplified = await asyncio.to_thread(
+        lambda: (compress_text(document_data['original_text']), compress_text(document_data['simplified_text']))
+    )
+    if clauses is not None:
+        clause_index = await asyncio.to_thread(
+            ClauseIndex.build, ClauseSegmenter.texts(document_data['original_text'], clauses)
+        )
+    clause_indexes.pop(document_data['id'])
+    async with db.write() as conn:
+        await delete_document_rows(conn, document_data['id'])
+        await conn.execute('''
+            INSERT INTO documents (id, filename, language, processing_time, clause_count, word_count, status, upload_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            document_data['id'],
+            document_data['filename'],
+            document_data['language'],
+            document_data['processing_time'],
+            document_data['clause_count'],
+            document_data['word_count'],
+            document_data['status'],
+            document_data['upload_time']
+        ))
+        await conn.execute(
+            'INSERT INTO document_bodies (document_id, original_text, simplified_text) VALUES (?, ?, ?)',
+            (document_data['id'], original, simplified)
+        )
+        await document_stats.apply(
+            conn, document_data['language'], document_data['status'],
+            document_data['word_count'], document_data['processing_time'], 1
+        )
+        if clauses is not None:
+            await write_clauses(conn, document_data['id'], clauses, clause_index)
+    if clauses is not None:
+        clause_indexes.put(document_data['id'], (clauses, clause_index))
+
+async def get_document_from_db(doc_id: str, include_body: bool = False):
+    """Get a document's metadata, plus its original_text and simplified_text if include_body"""
+    async with db.read() as conn:
+        cursor = await conn.execute('''
+            SELECT id, filename, language, processing_time, clause_count, word_count, status, upload_time
+            FROM documents WHERE id = ?
+        ''', (doc_id,))
+        row = await cursor.fetchone()
+        if row is None:
+            return None
+        document = dict(row)
+        if include_body:
+            cursor = await conn.execute(
+                'SELECT original_text, simplified_text FROM document_text WHERE document_id = ?', (doc_id,)
+            )
+            body = await cursor.fetchone()
+            document['original_text'] = body['original_text'] if body else None
+            document['simplified_text'] = body['simplified_text'] if body else None
+    return document
+
+def encode_documents_cursor(upload_time: str, doc_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([upload_time, doc_id]).encode('utf-8')).decode('ascii')
+
+def decode_documents_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        upload_time, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(upload_time, str) or not isinstance(doc_id, str):
+            raise ValueError("cursor fields must be strings")
+        return upload_time, doc_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def list_documents_from_db(limit: int, cursor: Optional[str] = None, status: Optional[str] = None,
+                                 language: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """Return one page of documents, newest first, and the cursor of the next page
+
+    Pages are keyed on (upload_time, id) rather than an offset, so every page is a
+    bounded index range scan however far into the table it is.
+    """
+    conditions = []
+    params: List[Any] = []
+    if cursor:
+        conditions.append('(upload_time, id) < (?, ?)')
+        params.extend(decode_documents_cursor(cursor))
+    if status:
+        conditions.append('status = ?')
+        params.append(status)
+    if language:
+        conditions.append('language = ?')
+        params.append(language)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    async with db.read() as conn:
+        rows = await conn.execute_fetchall(f'''
+            SELECT id, filename, upload_time, language, word_count, status FROM documents
+            {where}
+            ORDER BY upload_time DESC, id DESC
+            LIMIT ?
+        ''', (*params, limit + 1))
+
+    documents = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = documents[-1]
+        next_cursor = encode_documents_cursor(last['upload_time'], last['id'])
+    return documents, next_cursor
+
+def build_search_query(text: str) -> str:
+    """Turn free text into an FTS5 query that matches documents containing every word
+
+    Words are quoted so FTS5 operators and punctuation are matched as plain text;
+    a trailing * is kept as a prefix search.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*") and len(word) > 1
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return " ".join(terms)
+
+async def search_documents_in_db(query: str, limit: int, offset: int = 0, language: Optional[str] = None,
+                                 status: Optional[str] = None) -> Tuple[List[dict], bool, bool]:
+    """Search documents matching query and return (page of results, whether more follow, truncated)
+
+    BM25 scores every match before it can sort, so when more than SEARCH_RANK_WINDOW
+    documents match (after the language and status filters) only the newest
+    SEARCH_RANK_WINDOW of them are ranked, which keeps common-word searches about as fast
+    as rare ones. truncated tells the caller that older matches were left out. Snippets
+    are only built for the page being returned.
+    """
+    conditions = ['documents_fts MATCH ?']
+    params: List[Any] = [query]
+    join = ""
+    if language or status:
+        join = '''
+            JOIN document_bodies b ON b.body_id = documents_fts.rowid
+            JOIN documents d ON d.id = b.document_id
+        '''
+    if language:
+        conditions.append('d.language = ?')
+        params.append(language)
+    if status:
+        conditions.append('d.status = ?')
+        params.append(status)
+
+    async with db.read() as conn:
+        # Matches come out of FTS5 in body_id (upload) order, so finding the window's edge is cheap
+        edge = await conn.execute_fetchall(f'''
+            SELECT documents_fts.rowid FROM documents_fts {join}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY documents_fts.rowid DESC
+            LIMIT 1 OFFSET ?
+        ''', (*params, SEARCH_RANK_WINDOW))
+        if edge:
+            conditions.append('documents_fts.rowid > ?')
+            params.append(edge[0][0])
+
+        ranked = await conn.execute_fetchall(f'''
+            SELECT documents_fts.rowid, bm25(documents_fts, 1.0, 0.5) AS score
+            FROM documents_fts {join}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY score
+            LIMIT ? OFFSET ?
+        ''', (*params, limit + 1, offset))
+
+        results = []
+        for rowid, score in ranked[:limit]:
+            cursor = await conn.execute('''
+                SELECT d.id, d.filename, d.language, d.status, d.upload_time,
+                       snippet(documents_fts, -1, '<mark>', '</mark>', '…', ?) AS snippet
+                FROM documents_fts
+                JOIN document_bodies b ON b.body_id = documents_fts.rowid
+                JOIN documents d ON d.id = b.document_id
+                WHERE documents_fts MATCH ? AND documents_fts.rowid = ?
+            ''', (SEARCH_SNIPPET_TOKENS, query, rowid))
+            row = await cursor.fetchone()
+            if row:
+                # bm25() is lower-is-better; report higher-is-better
+                results.append({**dict(row), "score": round(-score, 4)})
+    return results, len(ranked) > limit, bool(edge)
+
+async def write_clauses(conn: aiosqlite.Connection, doc_id: str, clauses: List[Clause], clause_index: ClauseIndex):
+    """Replace a document's clause rows and clause index in the caller's transaction"""
+    await conn.execute('DELETE FROM clauses WHERE document_id = ?', (doc_id,))
+    await conn.executemany(
+        'INSERT INTO clauses (document_id, seq, kind, number, start_offset, end_offset) VALUES (?, ?, ?, ?, ?, ?)',
+        [(doc_id, seq, clause.kind, clause.number, clause.start, clause.end) for seq, clause in enumerate(clauses)]
+    )
+    await conn.execute(
+        'INSERT OR REPLACE INTO clause_indexes (document_id, postings) VALUES (?, ?)',
+        (doc_id, json.dumps(clause_index.postings, ensure_ascii=False))
+    )
+
+async def load_clauses(doc_id: str, text: str) -> Tuple[List[Clause], ClauseIndex]:
+    """Get a document's clauses and their index, keeping recently used ones in memory
+
+    text is the document's original text, which the clause offsets point into. A
+    document stored before clauses were kept is segmented here, once.
+    """
+    cached = clause_indexes.get(doc_id)
+    if cached is not None:
+        return cached
+
+    async with db.read() as conn:
+        cursor = await conn.execute('SELECT postings FROM clause_indexes WHERE document_id = ?', (doc_id,))
+        index_row = await cursor.fetchone()
+        cursor = await conn.execute(
+            'SELECT kind, number, start_offset, end_offset FROM clauses WHERE document_id = ? ORDER BY seq', (doc_id,)
+        )
+        rows = await cursor.fetchall()
+
+    if index_row is None:
+        clauses = await asyncio.to_thread(clause_segmenter.segment, text)
+        clause_index = await asyncio.to_thread(ClauseIndex.build, ClauseSegmenter.texts(text, clauses))
+        async with db.write() as conn:
+            cursor = await conn.execute(
+                'UPDATE documents SET clause_count = ? WHERE id = ?', (len(clause_index.clauses), doc_id)
+            )
+            if cursor.rowcount:
+                await write_clauses(conn, doc_id, clauses, clause_index)
+    else:
+        clauses = [Clause(row['start_offset'], row['end_offset'], row['kind'], row['number']) for row in rows]
+        postings = {term: [tuple(entry) for entry in entries] for term, entries in json.loads(index_row['postings']).items()}
+        clause_index = ClauseIndex(ClauseSegmenter.texts(text, clauses), postings)
+
+    clause_indexes.put(doc_id, (clauses, clause_index))
+    return clauses, clause_index
+
+clause_indexes = LRUCache(CLAUSE_INDEX_CACHE_SIZE)
+
+async def delete_document_rows(conn: aiosqlite.Connection, doc_id: str):
+    """Delete a document and everything stored with it in the caller's transaction"""
+    cursor = await conn.execute(
+        'DELETE FROM documents WHERE id = ? RETURNING language, status, word_count, processing_time', (doc_id,)
+    )
+    row = await cursor.fetchone()
+    if row:
+        await document_stats.apply(conn, row['language'], row['status'], row['word_count'],
+                                   row['processing_time'], -1)
+    await conn.execute('DELETE FROM document_bodies WHERE document_id = ?', (doc_id,))
+    await conn.execute('DELETE FROM clauses WHERE document_id = ?', (doc_id,))
+    await conn.execute('DELETE FROM clause_indexes WHERE document_id = ?', (doc_id,))
+
+async def delete_document_from_db(doc_id: str):
+    async with db.write() as conn:
+        await delete_document_rows(conn, doc_id)
+    clause_indexes.pop(doc_id)
+
+async def append_chat_turn(session_id: str, document_id: Optional[str], user_message: str, ai_response: str) -> int:
+    """Append one turn to a chat session, creating the session on its first turn; returns the turn's seq
+
+    Each turn is a single row insert, however long the conversation already is.
+    """
+    now = datetime.now().isoformat()
+    async with db.write() as conn:
+        await conn.execute('''
+            INSERT INTO chat_sessions (session_id, document_id, created_at, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET updated_at = excluded.updated_at
+        ''', (session_id, document_id, now, now))
+        cursor = await conn.execute('''
+            INSERT INTO chat_messages (session_id, seq, user_message, ai_response, created_at)
+            VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM chat_messages WHERE session_id = ?), ?, ?, ?)
+            RETURNING seq
+        ''', (session_id, session_id, user_message, ai_response, now))
+        row = await cursor.fetchone()
+    return row['seq']
+
+async def get_chat_session(session_id: str):
+    async with db.read() as conn:
+        cursor = await conn.execute(
+            'SELECT session_id, document_id, created_at, updated_at FROM chat_sessions WHERE session_id = ?',
+            (session_id,)
+        )
+        row = await cursor.fetchone()
+    return dict(row) if row else None
 
-# Helper Functions
-class DocumentProcessor:
-    @staticmethod
-    def extract_text_from_pdf(file_content: bytes) -> str:
+async def get_chat_messages(session_id: str, after_seq: int, limit: int) -> Tuple[List[dict], bool]:
+    """Return up to limit turns of a session with seq > after_seq, oldest first, and whether more follow"""
+    async with db.read() as conn:
+        rows = await conn.execute_fetchall('''
+            SELECT seq, user_message, ai_response, created_at FROM chat_messages
+            WHERE session_id = ? AND seq > ?
+            ORDER BY seq
+            LIMIT ?
+        ''', (session_id, after_seq, limit + 1))
+    return [dict(row) for row in rows[:limit]], len(rows) > limit
+
+# LLM response cache
+_touch_tasks: set = set()
+
+def touch_last_access(table: str, keys: List[str], now: float):
+    """Refresh cache entries' last_access in the background, so a cache hit never waits for the writer"""
+    async def touch():
         try:
-            pdf_reader = PyPDF2.PdfReader(BytesIO(file_content))
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            return text.strip()
+            async with db.write() as conn:
+                await conn.executemany(f'UPDATE {table} SET last_access = ? WHERE key = ?', [(now, key) for key in keys])
         except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error processing PDF: {str(e)}")
+            logger.warning(f"Could not refresh {table} last_access: {str(e)}")
+
+    task = asyncio.ensure_future(touch())
+    _touch_tasks.add(task)
+    task.add_done_callback(_touch_tasks.discard)
+
+class ResponseCache:
+    """Two-tier cache of model responses: an in-process LRU in front of the llm_cache table
+
+    Entries expire after ttl seconds; the table is trimmed to max_entries by last access.
+    """
+
+    # Trim the table every this many writes rather than on each one
+    TRIM_EVERY = 100
+
+    def __init__(self, memory_entries: int, max_entries: int, ttl: int):
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     @staticmethod
-    def extract_text_from_docx(file_content: bytes) -> str:
+    def make_key(model: str, temperature: float, max_tokens: int, messages: List[Dict[str, str]]) -> str:
+        input_hash = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode('utf-8')).hexdigest()
+        key = json.dumps([PROMPT_TEMPLATE_VERSION, model, temperature, max_tokens, input_hash])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, created_at: float, response: str):
+        self._memory[key] = (created_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            if now - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            del self._memory[key]
+
         try:
-            doc = DocxDocument(BytesIO(file_content))
-            text = ""
-            for paragraph in doc.paragraphs:
-                text += paragraph.text + "\n"
-            return text.strip()
+            async with db.read() as conn:
+                cursor = await conn.execute(
+                    'SELECT response, created_at, last_access FROM llm_cache WHERE key = ?', (key,)
+                )
+                row = await cursor.fetchone()
+            if row and now - row['created_at'] < self.ttl:
+                if now - row['last_access'] >= LLM_CACHE_TOUCH_INTERVAL:
+                    touch_last_access('llm_cache', [key], now)
+                self._remember(key, row['created_at'], row['response'])
+                self.disk_hits += 1
+                return row['response']
         except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error processing DOCX: {str(e)}")
+            logger.warning(f"LLM cache lookup failed: {str(e)}")
 
-    @staticmethod
-    def extract_text_from_image(file_content: bytes) -> str:
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, response: str):
+        now = time.time()
+        self._remember(key, now, response)
         try:
-            image = Image.open(BytesIO(file_content))
-            text = pytesseract.image_to_string(image)
-            return text.strip()
+            async with db.write() as conn:
+                await conn.execute(
+                    'INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)',
+                    (key, response, now, now)
+                )
+                self._writes += 1
+                if self._writes % self.TRIM_EVERY == 0:
+                    await self._trim(conn, now)
         except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
+            logger.warning(f"LLM cache write failed: {str(e)}")
 
-class AIService:
-    def __init__(self):
-        openai.api_key = OPENAI_API_KEY
+    async def _trim(self, conn, now: float):
+        cursor = await conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+        self.evictions += max(cursor.rowcount, 0)
+        cursor = await conn.execute('''
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_access
+                LIMIT max((SELECT COUNT(*) FROM llm_cache) - ?, 0)
+            )
+        ''', (self.max_entries,))
+        self.evictions += max(cursor.rowcount, 0)
 
-    async def simplify_legal_text(self, text: str, language: str = "en", complexity: str = "simple") -> str:
-        """Simplify legal text using AI"""
-        
-        language_prompts = {
-            "en": "Simplify this legal document into plain English",
-            "hi": "इस कानूनी दस्तावेज़ को सरल हिंदी में समझाएं",
-            "mr": "या कायदेशीर कागदपत्राचे मराठीत सोप्या भाषेत स्पष्टीकरण द्या"
-        }
-        
-        complexity_levels = {
-            "simple": "Use very simple language that a 12-year-old could understand",
-            "intermediate": "Use clear language suitable for high school graduates",
-            "advanced": "Use professional but clear language suitable for college graduates"
+    def stats(self) -> Dict[str, Any]:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "evictions": self.evictions
         }
 
-        prompt = f"""
-        {language_prompts.get(language, language_prompts["en"])}.
-        
-        {complexity_levels.get(complexity, complexity_levels["simple"])}.
-        
-        Please:
-        1. Break down complex legal terms into simple explanations
-        2. Explain what each clause means in practical terms
-        3. Highlight key rights and obligations
-        4. Use bullet points for clarity
-        5. Maintain the document structure but make it readable
-        
-        Original legal text:
-        {text[:4000]}  # Limit text to avoid token limits
-        """
+response_cache = ResponseCache(LLM_CACHE_MEMORY_ENTRIES, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS)
+
+class ClauseSimplificationCache:
+    """Simplified clauses shared across documents: an in-process LRU in front of the clause_simplifications table
+
+    Keyed by model, prompt version, language, complexity and the clause's normalized
+    text. Entries don't expire; the table is trimmed to max_entries by last access.
+    """
+
+    TRIM_EVERY = 100
+    # Keys per IN (...) lookup
+    LOOKUP_BATCH = 500
+
+    def __init__(self, memory_entries: int, max_entries: int):
+        self.max_entries = max_entries
+        self._memory = LRUCache(memory_entries)
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(language: str, complexity: str, normalized: str) -> str:
+        key = json.dumps([PROMPT_TEMPLATE_VERSION, OPENAI_MODEL, language, complexity, normalized], ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    async def get_many(self, keys: List[str]) -> Dict[str, str]:
+        found: Dict[str, str] = {}
+        missing = []
+        for key in keys:
+            simplified = self._memory.get(key)
+            if simplified is None:
+                missing.append(key)
+            else:
+                found[key] = simplified
+        self.memory_hits += len(found)
 
         try:
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a legal expert who specializes in simplifying complex legal documents for ordinary people."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=2000,
-                temperature=0.3
-            )
-            
-            return response.choices[0].message.content
+            now = time.time()
+            from_disk: Dict[str, str] = {}
+            stale: List[str] = []
+            async with db.read() as conn:
+                for i in range(0, len(missing), self.LOOKUP_BATCH):
+                    batch = missing[i:i + self.LOOKUP_BATCH]
+                    cursor = await conn.execute(
+                        f'SELECT key, simplified, last_access FROM clause_simplifications '
+                        f'WHERE key IN ({",".join("?" * len(batch))})',
+                        batch
+                    )
+                    for row in await cursor.fetchall():
+                        from_disk[row['key']] = row['simplified']
+                        if now - row['last_access'] >= LLM_CACHE_TOUCH_INTERVAL:
+                            stale.append(row['key'])
+            if stale:
+                touch_last_access('clause_simplifications', stale, now)
+            if from_disk:
+                for key, simplified in from_disk.items():
+                    self._memory.put(key, simplified)
+                found.update(from_disk)
+                self.disk_hits += len(from_disk)
         except Exception as e:
-            # Fallback to rule-based simplification if AI fails
-            return self.rule_based_simplification(text, language)
+            logger.warning(f"Clause cache lookup failed: {str(e)}")
 
-    def _chunk_text(self, text: str, chunk_size: int) -> List[str]:
-        """Split text into manageable chunks for processing"""
-        words = text.split()
-        chunks = []
-        
-        for i in range(0, len(words), chunk_size):
-            chunk = " ".join(words[i:i+chunk_size])
-            chunks.append(chunk)
-            
-        return chunks
+        self.misses += len(keys) - len(found)
+        return found
 
-    def rule_based_simplification(self, text: str, language: str) -> str:
-        """Fallback rule-based simplification"""
-        
-        # Simple keyword replacement
-        replacements = {
-            "whereas": "given that",
-            "heretofore": "before this",
-            "hereinafter": "from now on",
-            "aforementioned": "mentioned above",
-            "pursuant to": "according to",
-            "notwithstanding": "despite",
-            "ipso facto": "by that very fact",
-            "party of the first part": "first party",
-            "party of the second part": "second party",
-            "shall": "will",
-            "hereby": "by this",
-            "herein": "in this document",
-            "thereof": "of that",
-            "witnesseth": "shows that"
+    async def set_many(self, entries: Dict[str, str]):
+        if not entries:
+            return
+        now = time.time()
+        for key, simplified in entries.items():
+            self._memory.put(key, simplified)
+        try:
+            async with db.write() as conn:
+                await conn.executemany(
+                    'INSERT OR REPLACE INTO clause_simplifications (key, simplified, created_at, last_access) VALUES (?, ?, ?, ?)',
+                    [(key, simplified, now, now) for key, simplified in entries.items()]
+                )
+                self._writes += 1
+                if self._writes % self.TRIM_EVERY == 0:
+                    cursor = await conn.execute('''
+                        DELETE FROM clause_simplifications WHERE key IN (
+                            SELECT key FROM clause_simplifications ORDER BY last_access
+                            LIMIT max((SELECT COUNT(*) FROM clause_simplifications) - ?, 0)
+                        )
+                    ''', (self.max_entries,))
+                    self.evictions += max(cursor.rowcount, 0)
+        except Exception as e:
+            logger.warning(f"Clause cache write failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "evictions": self.evictions
         }
-    
-        simplified = text
-        for old, new in replacements.items():
-            simplified = simplified.replace(old, new)
-        
-        return f"Simplified version: {simplified}"
 
-    async def answer_question(self, question: str, document_text: str, language: str = "en") -> dict:
-        """Answer questions about the document"""
-        
-        prompt = f"""
-        Based on the following legal document, please answer this question: {question}
-        
-        Document content:
-        {document_text[:3000]}
-        
-        Please provide:
-        1. A clear, direct answer
-        2. Reference to specific clauses if applicable
-        3. Practical implications
-        4. Any important warnings or considerations
-        
-        Answer in {language} language.
-        """
+clause_simplifications = ClauseSimplificationCache(CLAUSE_CACHE_MEMORY_ENTRIES, CLAUSE_CACHE_MAX_ENTRIES)
+
+# Background job queue
+class JobQueue:
+    """SQLite-backed queue of document processing jobs drained by a bounded pool of async workers
+
+    Running jobs refresh heartbeat_at; a job whose heartbeat goes stale (its process
+    died mid-job) is put back in the queue, or failed once it has used up its attempts.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def enqueue(self, job: dict) -> str:
+        job_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        async with db.write() as conn:
+            await conn.execute('''
+                INSERT INTO jobs (id, document_id, filename, file_path, file_ext, content_hash,
+                                  language, complexity, status, attempts, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', 0, ?, ?)
+            ''', (
+                job_id,
+                job['document_id'],
+                job['filename'],
+                job['file_path'],
+                job['file_ext'],
+                job['content_hash'],
+                job['language'],
+                job['complexity'],
+                now,
+                now
+            ))
+        self._wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        async with db.read() as conn:
+            cursor = await conn.execute('''
+                SELECT id, document_id, filename, status, attempts, error, created_at, updated_at
+                FROM jobs WHERE id = ?
+            ''', (job_id,))
+            row = await cursor.fetchone()
+        return dict(row) if row else None
+
+    async def _claim(self) -> Optional[dict]:
+        """Atomically move the oldest queued job to running"""
+        now = datetime.now().isoformat()
+        async with db.write() as conn:
+            cursor = await conn.execute('''
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?, heartbeat_at = ?
+                WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+                RETURNING *
+            ''', (now, now))
+            row = await cursor.fetchone()
+        return dict(row) if row else None
+
+    async def _update(self, job_id: str, status: str, error: Optional[str] = None):
+        async with db.write() as conn:
+            await conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?',
+                (status, error, datetime.now().isoformat(), job_id)
+            )
 
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            async with db.write() as conn:
+                await conn.execute('UPDATE jobs SET heartbeat_at = ? WHERE id = ?', (datetime.now().isoformat(), job_id))
+
+    async def recover_stale_jobs(self) -> int:
+        """Requeue running jobs whose worker stopped sending heartbeats"""
+        stale_before = datetime.fromtimestamp(datetime.now().timestamp() - JOB_HEARTBEAT_INTERVAL * 3).isoformat()
+        async with db.write() as conn:
+            cursor = await conn.execute('''
+                UPDATE jobs
+                SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                    error = 'Worker stopped while processing the job',
+                    updated_at = ?
+                WHERE status = 'running' AND heartbeat_at < ?
+            ''', (JOB_MAX_ATTEMPTS, datetime.now().isoformat(), stale_before))
+            recovered = cursor.rowcount
+        if recovered:
+            logger.warning(f"Recovered {recovered} stale job(s)")
+            self._wakeup.set()
+        return recovered
+
+    async def _run(self, job: dict):
+        self.active += 1
+        heartbeat = asyncio.create_task(self._heartbeat(job['id']))
         try:
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful legal assistant. Provide accurate information based on the document, but always remind users to consult a lawyer for official legal advice."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=1000,
-                temperature=0.2
+            extraction = await extract_with_cache(job['file_path'], job['file_ext'], job['content_hash'])
+            await process_document_async(
+                job['document_id'], job['filename'], extraction['text'],
+                job['language'], job['complexity'], job['file_path'], extraction['clauses']
             )
-            
-            return {
-                "response": response.choices[0].message.content,
-                "confidence": 0.85,
-                "relevant_clauses": self.extract_relevant_clauses(document_text, question)
-            }
+            await self._update(job['id'], 'completed')
+            self.completed += 1
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back so the next start picks it up
+            await asyncio.shield(self._update(job['id'], 'queued', 'Interrupted by shutdown'))
+            raise
         except Exception as e:
-            return {
-                "response": f"I apologize, but I encountered an error processing your question: {str(e)}. Please try rephrasing your question or contact support.",
-                "confidence": 0.0,
-                "relevant_clauses": []
-            }
+            logger.error(f"Job {job['id']} failed on attempt {job['attempts']}: {str(e)}")
+            # Client errors (unreadable files etc.) will not succeed on retry; 5xx ones (a busy or crashed pool) may
+            client_error = isinstance(e, HTTPException) and e.status_code < 500
+            retry = not client_error and job['attempts'] < JOB_MAX_ATTEMPTS
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+            await self._update(job['id'], 'queued' if retry else 'failed', error)
+            if retry:
+                self._wakeup.set()
+            else:
+                self.failed += 1
+                if os.path.exists(job['file_path']):
+                    os.remove(job['file_path'])
+        finally:
+            heartbeat.cancel()
+            self.active -= 1
 
-    def extract_relevant_clauses(self, text: str, question: str) -> List[str]:
-        """Extract clauses relevant to the question"""
-        # Simple keyword matching - in production, use more sophisticated NLP
-        question_words = question.lower().split()
-        sentences = text.split('.')
-        relevant = []
-        
-        for sentence in sentences[:20]:  # Limit to first 20 sentences
-            if any(word in sentence.lower() for word in question_words):
-                relevant.append(sentence.strip())
-                
-        return relevant[:3]  # Return top 3 relevant clauses
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Error claiming job: {str(e)}")
+                job = None
+            if job is not None:
+                await self._run(job)
+                continue
 
-# Database helper functions
-async def get_db_connection():
-    conn = await aiosqlite.connect('docx_legal_ai.db')
-    conn.row_factory = aiosqlite.Row
-    return conn
+            self._wakeup.clear()
+            try:
+                # Poll as well, for jobs enqueued by other processes
+                await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
-async def save_document_to_db(document_data: dict):
-    conn = await get_db_connection()
-    try:
-        await conn.execute('''
-            INSERT INTO documents (id, filename, original_text, simplified_text, language, 
-                                  processing_time, clause_count, word_count, status, upload_time)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            document_data['id'],
-            document_data['filename'],
-            document_data['original_text'],
-            document_data['simplified_text'],
-            document_data['language'],
-            document_data['processing_time'],
-            document_data['clause_count'],
-            document_data['word_count'],
-            document_data['status'],
-            document_data['upload_time']
-        ))
-        await conn.commit()
-    finally:
-        await conn.close()
+    async def _reaper(self):
+        while True:
+            try:
+                await self.recover_stale_jobs()
+            except Exception as e:
+                logger.error(f"Error recovering stale jobs: {str(e)}")
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
 
-async def get_document_from_db(doc_id: str):
-    conn = await get_db_connection()
-    try:
-        cursor = await conn.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
-        row = await cursor.fetchone()
-        if row:
-            return {
-                'id': row[0],
-                'filename': row[1],
-                'simplified_text': row[2],
-                'status': row[3],
-                'upload_time': row[4]
-            }
-        return None
-    finally:
-        await conn.close()
+    def start(self):
+        self._wakeup.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._reaper()))
 
-async def get_all_documents_from_db():
-    conn = await get_db_connection()
-    try:
-        cursor = await conn.execute('SELECT id, filename, status, upload_time FROM documents ORDER BY upload_time DESC')
-        rows = cursor.fetchall()
-        
-        documents = [
-            {
-                "id": row[0],
-                "filename": row[1],
-                "status": row[2],
-                "upload_time": row[3]
-            }
-            for row in rows
-        ]
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
 
+    def stats(self) -> Dict[str, int]:
         return {
-            "documents": documents,
-            "total_count": len(documents)
+            "workers": self.workers,
+            "active": self.active,
+            "completed": self.completed,
+            "failed": self.failed
         }
-    finally:
-        await conn.close()
 
-async def delete_document_from_db(doc_id: str):
-    conn = await get_db_connection()
-    try:
-        await conn.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
-        await conn.commit()
-    finally:
-        await conn.close()
-
-async def save_chat_session(session_id: str, document_id: str, messages: str):
-    conn = await get_db_connection()
-    try:
-        await conn.execute('''
-            INSERT OR REPLACE INTO chat_sessions (session_id, document_id, messages, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (session_id, document_id, messages, datetime.now().isoformat(), datetime.now().isoformat()))
-        await conn.commit()
-    finally:
-        await conn.close()
-
-async def get_chat_session(session_id: str):
-    conn = await get_db_connection()
-    try:
-        cursor = await conn.execute('SELECT * FROM chat_sessions WHERE session_id = ?', (session_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        await conn.close()
+job_queue = JobQueue(JOB_WORKERS)
 
 # Initialize AI service
 ai_service = AIService()
@@ -425,14 +3419,34 @@ async def root():
         "status": "active",
         "endpoints": {
             "upload": "/upload-document",
+            "jobs": "/jobs/{job_id}",
             "simplify": "/simplify",
             "chat": "/chat",
             "health": "/health",
             "documents": "/documents",
-            "stats": "/stats"
+            "stats": "/stats",
+            "search": "/search",
+            "diagnostics": "/diagnostics"
         }
     }
 
+@app.on_event("startup")
+async def start_workers():
+    await db.open()
+    document_stats.start()
+    job_queue.start()
+    # Load the tokenizer off the event loop; it may fetch its encoding on first use
+    asyncio.ensure_future(asyncio.to_thread(prompt_budget.load))
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    await job_queue.stop()
+    await document_stats.stop()
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(wait=False, cancel_futures=True)
+    ocr_pool.shutdown()
+    await db.close()
+
 @app.get("/health")
 async def health_check():
     return {
@@ -441,65 +3455,87 @@ async def health_check():
         "service": "DocX Legal AI"
     }
 
-@app.post("/upload-document")
+# The body is parsed by hand in receive_upload, so describe it for the OpenAPI docs
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"]
+                }
+            }
+        }
+    }
+}
+
+@app.post("/upload-document", status_code=202, openapi_extra=UPLOAD_REQUEST_BODY)
 async def upload_document(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
+    request: Request,
     language: str = "en",
     complexity: str = "simple"
 ):
-    """Upload and process a legal document"""
-    
-    # Validate file
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="No file provided")
-
-    file_ext = os.path.splitext(file.filename)[1].lower()
-    if file_ext not in SUPPORTED_FORMATS:
-        raise HTTPException(status_code=400, detail=f"Unsupported file format. Supported: {SUPPORTED_FORMATS}")
+    """Upload a legal document and queue it for processing"""
 
+    filename, file_ext, file_path, content_hash = await receive_upload(request)
     try:
-        # Read file content
-        content = await file.read()
-        
-        # For text files, decode the content
-        if file_ext == '.txt':
-            text = content.decode('utf-8')
-        else:
-            # For PDF, we'd use PyPDF2 in a real implementation
-            text = f"Content from {file.filename} would be extracted here."
-        
-        # Generate document ID
+        # Extraction and simplification happen in the job workers; the job owns the file from here
         doc_id = str(uuid.uuid4())
-        simplified_text = ai_service.simplify_legal_text(text[:500])
-        
-        doc_data = {
-            "id": doc_id,
-            "filename": file.filename,
-            "simplified_text": simplified_text,
-            "status": "completed",
-            "upload_time": datetime.now().isoformat()
-        }
-        
-        save_document_to_db(doc_data)
+        job_id = await job_queue.enqueue({
+            "document_id": doc_id,
+            "filename": filename,
+            "file_path": file_path,
+            "file_ext": file_ext,
+            "content_hash": content_hash,
+            "language": language,
+            "complexity": complexity
+        })
         
         return {
+            "job_id": job_id,
             "id": doc_id,
-            "filename": file.filename,
-            "simplified_text": simplified_text,
-            "status": "completed"
+            "filename": filename,
+            "status": "queued"
         }
         
     except Exception as e:
+        os.remove(file_path)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get the status of a document processing job"""
+
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job
+
 async def process_document_async(doc_id: str, filename: str, original_text: str, 
-                               language: str, complexity: str, file_path: str):
-    """Background task to process document"""
+                               language: str, complexity: str, file_path: str,
+                               clauses: Optional[List[Clause]] = None):
+    """Background task to process document
+
+    Safe to run again for the same document: a document already completed (by an
+    attempt that died before its job was marked done) is left as it is. A failure
+    stores an error document and is re-raised, so the job queue can retry it.
+    """
+    existing = await get_document_from_db(doc_id)
+    if existing and existing['status'] == 'completed':
+        logger.info(f"Document {doc_id} was already processed")
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+
+    if clauses is None:
+        clauses = await asyncio.to_thread(clause_segmenter.segment, original_text)
     try:
         # Simplify text using AI
         start_time = datetime.now()
-        simplified_text = await ai_service.simplify_legal_text(original_text, language, complexity)
+        simplified_text = await ai_service.simplify_document(original_text, language, complexity, clauses)
         processing_time = (datetime.now() - start_time).total_seconds()
         
         # Store document
@@ -510,14 +3546,14 @@ async def process_document_async(doc_id: str, filename: str, original_text: str,
             "simplified_text": simplified_text,
             "language": language,
             "processing_time": processing_time,
-            "clause_count": len([s for s in original_text.split('.') if len(s.strip()) > 20]),
+            "clause_count": sum(1 for clause in clauses if clause.kind == "clause"),
             "word_count": len(original_text.split()),
             "upload_time": datetime.now().isoformat(),
             "status": "completed"
         }
         
         # Save to database
-        await save_document_to_db(doc_data)
+        await save_document_to_db(doc_data, clauses)
         
         # Clean up uploaded file
         if os.path.exists(file_path):
@@ -543,6 +3579,8 @@ async def process_document_async(doc_id: str, filename: str, original_text: str,
         }
         
         await save_document_to_db(error_doc_data)
+        # The job queue removes the upload once it gives up retrying
+        raise
 
 @app.post("/simplify")
 async def simplify_text(request: SimplificationRequest):
@@ -555,91 +3593,295 @@ async def simplify_text(request: SimplificationRequest):
             request.complexity_level
         )
         
-        return {
-            "original_text": request.text[:500] + "..." if len(request.text) > 500 else request.text,
-            "simplified_text": simplified,
+        return simplification_result(request, simplified)
+    except Exception as e:
+        logger.error(f"Error simplifying text: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error simplifying text: {str(e)}")
+
+def simplification_result(request: SimplificationRequest, simplified: str) -> dict:
+    return {
+        "original_text": request.text[:500] + "..." if len(request.text) > 500 else request.text,
+        "simplified_text": simplified,
+        "language": request.target_language,
+        "complexity_level": request.complexity_level,
+        "word_count_original": len(request.text.split()),
+        "word_count_simplified": len(simplified.split())
+    }
+
+@app.post("/simplify/batch")
+async def simplify_batch(batch: BatchSimplificationRequest):
+    """Simplify many texts at once, streaming one NDJSON line per item as it finishes
+
+    Lines carry the item's index in the request and a status of "ok" (with the fields
+    returned by /simplify) or "error" (with a detail); a failing item never affects the others.
+    """
+
+    if not batch.items:
+        raise HTTPException(status_code=400, detail="No items provided")
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items. Maximum is {BATCH_MAX_ITEMS}")
+    concurrency = max(1, min(batch.concurrency, BATCH_MAX_CONCURRENCY, len(batch.items)))
+
+    async def results():
+        finished: asyncio.Queue = asyncio.Queue()
+        pending = iter(enumerate(batch.items))
+
+        async def worker():
+            # Workers share one iterator, so each item is taken exactly once
+            for index, item in pending:
+                try:
+                    simplified = await ai_service.simplify_legal_text(
+                        item.text, item.target_language, item.complexity_level
+                    )
+                    line = {"index": index, "status": "ok", **simplification_result(item, simplified)}
+                except Exception as e:
+                    logger.error(f"Error simplifying batch item {index}: {str(e)}")
+                    line = {"index": index, "status": "error", "detail": f"Error simplifying text: {str(e)}"}
+                await finished.put(line)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            for _ in range(len(batch.items)):
+                yield json.dumps(await finished.get(), ensure_ascii=False) + "\n"
+        finally:
+            for task in workers:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.post("/simplify/sections")
+async def simplify_text_sections(request: SimplificationRequest):
+    """Simplify long legal text, streaming each section as NDJSON as soon as it is ready"""
+
+    async def sections():
+        async for index, total, section in ai_service.simplify_legal_text_stream(
+            request.text, request.target_language, request.complexity_level
+        ):
+            yield json.dumps({"index": index, "total": total, "simplified_text": section}) + "\n"
+
+    return StreamingResponse(sections(), media_type="application/x-ndjson")
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.post("/simplify/stream")
+async def simplify_text_stream(request: SimplificationRequest):
+    """Simplify legal text, streaming the result as server-sent events
+
+    Emits "token" events as text arrives, then a closing "done" event with the metadata
+    returned by /simplify.
+    """
+
+    async def events():
+        parts = []
+        try:
+            async for token in ai_service.stream_simplify(
+                request.text, request.target_language, request.complexity_level
+            ):
+                parts.append(token)
+                yield _sse_event("token", {"text": token})
+        except Exception as e:
+            logger.error(f"Error streaming simplification: {str(e)}")
+            yield _sse_event("error", {"detail": f"Error simplifying text: {str(e)}"})
+            return
+
+        simplified = "".join(parts)
+        yield _sse_event("done", {
             "language": request.target_language,
             "complexity_level": request.complexity_level,
             "word_count_original": len(request.text.split()),
             "word_count_simplified": len(simplified.split())
-        }
-    except Exception as e:
-        logger.error(f"Error simplifying text: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error simplifying text: {str(e)}")
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def load_chat_document(message: ChatMessage) -> Tuple[str, Optional[List[Clause]], Optional[ClauseIndex]]:
+    """Get the text a chat message is about, and the document's clauses and clause index"""
+    if message.document_id:
+        doc_data = await get_document_from_db(message.document_id, include_body=True)
+        if not doc_data:
+            raise HTTPException(status_code=404, detail="Document not found")
+        clauses, clause_index = await load_clauses(message.document_id, doc_data["original_text"])
+        return doc_data["original_text"], clauses, clause_index
+
+    # General legal question without specific document
+    return "General legal knowledge base", None, None
+
+async def resolve_chat_session(message: ChatMessage):
+    """Check a continued session exists; a message without document_id is about the session's document"""
+    if not message.session_id:
+        return
+    session = await get_chat_session(message.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    if message.document_id is None:
+        message.document_id = session["document_id"]
+    elif message.document_id != session["document_id"]:
+        raise HTTPException(status_code=400, detail="Chat session belongs to a different document")
+
+async def store_chat_turn(message: ChatMessage, response_text: str) -> str:
+    """Persist a question and its answer, returning the session ID"""
+    session_id = message.session_id or str(uuid.uuid4())
+    await append_chat_turn(session_id, message.document_id, message.message, response_text)
+    return session_id
 
 @app.post("/chat")
 async def chat_with_document(message: ChatMessage):
     """Chat about a specific document"""
     
     try:
-        # Get document if specified
-        document_text = ""
-        if message.document_id:
-            doc_data = await get_document_from_db(message.document_id)
-            if not doc_data:
-                raise HTTPException(status_code=404, detail="Document not found")
-            document_text = doc_data["original_text"]
-        else:
-            # General legal question without specific document
-            document_text = "General legal knowledge base"
+        await resolve_chat_session(message)
+        document_text, clauses, clause_index = await load_chat_document(message)
         
         # Get AI response
         response_data = await ai_service.answer_question(
             message.message, 
             document_text, 
-            message.language
+            message.language,
+            clause_index,
+            clauses
         )
         
-        # Generate session ID
-        session_id = f"chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{hash(message.message) % 1000}"
-        
-        # Store chat session
-        chat_data = {
-            "user_message": message.message,
-            "ai_response": response_data["response"],
-            "timestamp": datetime.now().isoformat(),
-            "document_id": message.document_id
-        }
-        
-        await save_chat_session(session_id, message.document_id, json.dumps([chat_data]))
-        
-        response_data["session_id"] = session_id
+        response_data["session_id"] = await store_chat_turn(message, response_data["response"])
         
         return response_data
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing chat: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
 
+@app.post("/chat/stream")
+async def chat_with_document_stream(message: ChatMessage):
+    """Chat about a specific document, streaming the answer as server-sent events
+
+    Emits "token" events as the answer arrives, then a closing "done" event with
+    confidence, relevant_clauses and session_id once the turn has been stored.
+    """
+
+    await resolve_chat_session(message)
+    document_text, clauses, clause_index = await load_chat_document(message)
+
+    async def events():
+        parts = []
+        result = None
+        try:
+            async for token in ai_service.stream_answer(message.message, document_text, message.language, clauses):
+                parts.append(token)
+                yield _sse_event("token", {"text": token})
+        except Exception as e:
+            if parts:
+                logger.error(f"Error streaming chat: {str(e)}")
+                yield _sse_event("error", {"detail": f"Error processing chat: {str(e)}"})
+                return
+            # Nothing was sent yet, so answer with the same apology /chat would give
+            result = ai_service.error_answer(e)
+            yield _sse_event("token", {"text": result["response"]})
+
+        if result is None:
+            result = {
+                "response": "".join(parts),
+                "confidence": 0.85,
+                "relevant_clauses": ai_service.extract_relevant_clauses(document_text, message.message, clause_index)
+            }
+
+        try:
+            session_id = await store_chat_turn(message, result["response"])
+        except Exception as e:
+            logger.error(f"Error storing chat: {str(e)}")
+            yield _sse_event("error", {"detail": f"Error processing chat: {str(e)}"})
+            return
+
+        yield _sse_event("done", {
+            "confidence": result["confidence"],
+            "relevant_clauses": result["relevant_clauses"],
+            "session_id": session_id
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/chat/{session_id}/messages")
+async def get_chat_history(
+    session_id: str,
+    after_seq: int = Query(0, ge=0),
+    limit: int = Query(CHAT_HISTORY_PAGE_SIZE, ge=1, le=CHAT_HISTORY_MAX_PAGE_SIZE)
+):
+    """Read a chat session's turns in order, one page at a time
+
+    Pass the returned next_after_seq as after_seq to get the following page; it is null on the last page.
+    """
+
+    session = await get_chat_session(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+
+    messages, has_more = await get_chat_messages(session_id, after_seq, limit)
+    return {
+        **session,
+        "messages": messages,
+        "next_after_seq": messages[-1]["seq"] if has_more else None
+    }
+
 @app.get("/document/{doc_id}")
-async def get_document(doc_id: str):
-    """Get document details"""
+async def get_document(doc_id: str, include_body: bool = False):
+    """Get document details; the original and simplified text are included only if include_body"""
     
-    doc_data = await get_document_from_db(doc_id)
+    doc_data = await get_document_from_db(doc_id, include_body)
     if not doc_data:
         raise HTTPException(status_code=404, detail="Document not found")
 
     return doc_data
 
 @app.get("/documents")
-async def list_documents():
-    """List all processed documents"""
-    
-    documents = await get_all_documents_from_db()
-    
+async def list_documents(
+    limit: int = Query(DOCUMENTS_PAGE_SIZE, ge=1, le=DOCUMENTS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    language: Optional[str] = None
+):
+    """List processed documents, newest first, one page at a time
+
+    Pass the returned next_cursor to get the following page; it is null on the last page.
+    """
+
+    documents, next_cursor = await list_documents_from_db(limit, cursor, status, language)
+
     return {
-        "documents": [
-            {
-                "id": doc["id"],
-                "filename": doc["filename"],
-                "upload_time": doc["upload_time"],
-                "language": doc["language"],
-                "word_count": doc["word_count"],
-                "status": doc["status"]
-            }
-            for doc in documents
-        ],
-        "total_count": len(documents)
+        "documents": documents,
+        "count": len(documents),
+        "next_cursor": next_cursor
+    }
+
+@app.get("/search")
+async def search_documents(
+    q: str,
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    language: Optional[str] = None,
+    status: Optional[str] = None
+):
+    """Full-text search across all documents, best matches first, with highlighted snippets"""
+
+    query = build_search_query(q)
+    if not query:
+        raise HTTPException(status_code=400, detail="Search query is empty")
+
+    try:
+        results, has_more, truncated = await search_documents_in_db(query, limit, offset, language, status)
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {str(e)}")
+
+    return {
+        "query": q,
+        "results": results,
+        "count": len(results),
+        "offset": offset,
+        "next_offset": offset + len(results) if has_more else None,
+        # Only the newest SEARCH_RANK_WINDOW matching documents were ranked
+        "truncated": truncated
     }
 
 @app.delete("/document/{doc_id}")
@@ -668,38 +3910,24 @@ async def get_supported_languages():
 @app.get("/stats")
 async def get_statistics():
     """Get application statistics"""
-    
-    documents = await get_all_documents_from_db()
-    total_docs = len(documents)
-    
-    if total_docs == 0:
-        return {
-            "total_documents_processed": 0,
-            "total_words_processed": 0,
-            "average_processing_time_seconds": 0,
-            "language_distribution": {},
-            "status_distribution": {}
-        }
-    
-    completed_docs = [doc for doc in documents if doc["status"] == "completed"]
-    total_words_processed = sum(doc["word_count"] for doc in completed_docs)
-    avg_processing_time = sum(doc["processing_time"] for doc in completed_docs) / len(completed_docs) if completed_docs else 0
-    
-    language_distribution = {}
-    status_distribution = {}
-    
-    for doc in documents:
-        lang = doc["language"]
-        status = doc["status"]
-        language_distribution[lang] = language_distribution.get(lang, 0) + 1
-        status_distribution[status] = status_distribution.get(status, 0) + 1
-    
+
+    return await document_stats.get()
+
+@app.get("/diagnostics")
+async def get_diagnostics():
+    """Get worker pool state"""
+
     return {
-        "total_documents_processed": total_docs,
-        "total_words_processed": total_words_processed,
-        "average_processing_time_seconds": round(avg_processing_time, 2),
-        "language_distribution": language_distribution,
-        "status_distribution": status_distribution
+        "ocr": ocr_pool.stats(),
+        "extraction_cache": extraction_cache.stats(),
+        "jobs": job_queue.stats(),
+        "llm_cache": response_cache.stats(),
+        "clause_cache": clause_simplifications.stats(),
+        "single_flight": ai_service._in_flight.stats(),
+        "tokens": prompt_budget.stats(),
+        "model_client": model_client.stats(),
+        "database": db.stats(),
+        "document_stats": document_stats.stats()
     }
 
 # Serve static files (for frontend)